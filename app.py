@@ -1,99 +1,132 @@
 from flask import Flask, render_template, request, redirect, url_for, make_response, Response
-import multiprocessing
+import json
 
-
-from led import LED
+import led_daemon
+import metrics
+import profiler
+import registry
+from led_daemon import LEDClient
+from shared_state import StateReader, ui_state
+from transitions import Transition
 
 
 app = Flask(__name__)
 
-led = LED()
-led_process = None
+led_daemon.spawn()
+led = LEDClient()
+led_state = StateReader()
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
+def query_params(args, exclude=()):
+    """Params from the query string, with R, G and B combined into rgb."""
+    params = {key: value for key, value in args.items() if key not in exclude + ("R", "G", "B")}
+    if "R" in args:
+        params["rgb"] = (args.get("R"), args.get("G"), args.get("B"))
+    return params
+
+@app.route("/patterns", methods=["GET"])
+def list_patterns():
+    """Every pattern with its parameters, types, defaults and ranges."""
+    return Response(json.dumps(registry.describe()), status=200, mimetype="application/json")
+
 @app.route("/led", methods=["GET"])
 def led_program():
-    global led
-    global led_process
+    """Switch pattern, blending in with ?transition=fade|wipe|dissolve&transition_s=N if given."""
     program = request.args.get("program")
-    R = request.args.get("R")
-    G = request.args.get("G")
-    B = request.args.get("B")   
-    delay_ms = request.args.get("delay_ms")
-    
     resp = {"program": program}
 
-    if led_process is not None:
-        led_process.kill()
-    ''' No color argument functions '''
-    
-    if program == "rainbowWipe":
-        led_process = multiprocessing.Process(target=led.rainbowWipe, 
-                                              kwargs={"delay_ms": int(delay_ms)})
-    elif program == "rainbowWipeAlwaysOn":
-        led_process = multiprocessing.Process(target=led.rainbowWipeAlwaysOn,
-                                              kwargs={"delay_ms": int(delay_ms)})
-    elif program == "randomWipe":
-        led_process = multiprocessing.Process(target=led.randomWipe,
-                                              kwargs={"delay_ms": int(delay_ms)})
-    # if program == "rainbowCycle":
-    #     led_process = multiprocessing.Process(target=led.rainbowCycle)
-    elif program == "theaterChaseRainbow":
-        led_process = multiprocessing.Process(target=led.theaterChaseRainbow,
-                                              kwargs={"delay_ms": int(delay_ms)})
-    elif program == "theaterChase":
-        rgb = (int(R), int(G), int(B))
-        led_process = multiprocessing.Process(target=led.theaterChase,
-                                              kwargs={"rgb": rgb,
-                                                      "delay_ms": int(delay_ms)})
-        
-    elif program == "theaterChaseRainbow":
-        led_process = multiprocessing.Process(target=led.theaterChaseRainbow,
-                                              kwargs={"delay_ms": int(delay_ms)})
-        
-    elif program == "solidColor":
-        rgb = (int(R), int(G), int(B))
-        led_process = multiprocessing.Process(target=led.solidColor,
-                                              kwargs={"rgb": rgb})
-        
-    elif program == "colorWipe":
-        rgb = (int(R), int(G), int(B))
-        led_process = multiprocessing.Process(target=led.colorWipe,
-                                              kwargs={"rgb": rgb,
-                                                      "delay_ms": int(delay_ms)})
-        
-    elif program == "rainbowWipe":
-        led_process = multiprocessing.Process(target=led.rainbowWipe,
-                                              kwargs={"delay_ms": int(delay_ms)})
-        
-    elif program == "colorShots":
-        led_process = multiprocessing.Process(target=led.colorShotsMultiple)
-
-    elif program == "clear":
-        led_process = multiprocessing.Process(target=led.clear)
-    else:
-        resp = resp.update({"status": "error", "message": "Invalid program"})
-        resp = Response(resp, status=400, mimetype="application/json")
-        return resp
-
-    led_process.start()
-
-    resp = resp.update({"status": "ok"})
-    resp = Response(resp, status=200, mimetype="application/json")
+    try:
+        params = registry.get(program).bind(**query_params(request.args,
+                                                          exclude=("program", "transition", "transition_s")))
+        spec = {key: request.args[arg] for key, arg in (("kind", "transition"), ("seconds", "transition_s"))
+                if arg in request.args}
+        transition = Transition.parse(spec).describe() if spec else None
+    except (ValueError, TypeError) as e:
+        resp.update({"status": "error", "message": str(e)})
+        return Response(json.dumps(resp), status=400, mimetype="application/json")
+
+    try:
+        led.start_pattern(program, transition, **params)
+    except OSError:
+        resp.update({"status": "error", "message": "LED daemon is not running"})
+        return Response(json.dumps(resp), status=503, mimetype="application/json")
+
+    resp.update({"status": "ok"})
+    resp = Response(json.dumps(resp), status=200, mimetype="application/json")
+    return resp
+
+@app.route("/params", methods=["GET"])
+def set_params():
+    """Stream color/speed/brightness changes into the running pattern without restarting it."""
+    try:
+        params = registry.parse_live(query_params(request.args))
+    except (ValueError, TypeError) as e:
+        resp = {"status": "error", "message": str(e)}
+        return Response(json.dumps(resp), status=400, mimetype="application/json")
+
+    try:
+        led.set_params(**params)
+    except OSError:
+        resp = {"status": "error", "message": "LED daemon is not running"}
+        return Response(json.dumps(resp), status=503, mimetype="application/json")
+
+    resp = {"status": "ok"}
+    resp = Response(json.dumps(resp), status=200, mimetype="application/json")
     return resp
 
 @app.route("/get_state", methods=["GET"])
 def get_state():
-    global led
-    resp = {"R": led.rgb[0], "G": led.rgb[1], "B": led.rgb[2],
-            "delay_ms": led.delay_ms,
-            "current_pattern": led.current_pattern}
-    resp = Response(resp, status=200, mimetype="application/json")
+    try:
+        state = led_state.read()
+    except (FileNotFoundError, TimeoutError):
+        resp = {"status": "error", "message": "LED daemon is not running"}
+        return Response(json.dumps(resp), status=503, mimetype="application/json")
+    resp = Response(json.dumps(ui_state(state)), status=200, mimetype="application/json")
     return resp
 
+@app.route("/profile/start", methods=["GET"])
+def start_profile():
+    """Profile the render loop for ?seconds=N, with ?allocations=1 to trace allocations too."""
+    try:
+        resp = led.request("profile", action="start", seconds=float(request.args.get("seconds", 10)),
+                           allocations=request.args.get("allocations") in ("1", "true"))
+    except ValueError as e:
+        resp = {"status": "error", "message": str(e)}
+    except OSError:
+        resp = {"status": "error", "message": "LED daemon is not running"}
+        return Response(json.dumps(resp), status=503, mimetype="application/json")
+    return Response(json.dumps(resp), status=200 if resp["status"] == "ok" else 400, mimetype="application/json")
+
+@app.route("/profile/stop", methods=["GET"])
+def stop_profile():
+    try:
+        resp = led.request("profile", action="stop")
+    except OSError:
+        resp = {"status": "error", "message": "LED daemon is not running"}
+        return Response(json.dumps(resp), status=503, mimetype="application/json")
+    return Response(json.dumps(resp), status=200, mimetype="application/json")
+
+@app.route("/profile", methods=["GET"])
+def get_profile():
+    """The last profile: ?format=report (default) or ?format=collapsed for flamegraph tools."""
+    extension = ".folded" if request.args.get("format") == "collapsed" else ".txt"
+    try:
+        with open(profiler.PROFILE_PATH + extension) as f:
+            text = f.read()
+    except FileNotFoundError:
+        return Response("No profile yet, or one is still running\n", status=404, mimetype="text/plain")
+    return Response(text, status=200, mimetype="text/plain")
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    try:
+        text = metrics.prometheus(led_state.read_metrics(), led_state.read())
+    except (FileNotFoundError, TimeoutError):
+        return Response("LED daemon is not running\n", status=503, mimetype="text/plain")
+    return Response(text, status=200, mimetype="text/plain; version=0.0.4")
 
 # @app.route("/get_rgb", methods=["GET"])
 # def get_rgb():
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+'''
+Asyncio server mode for the web UI.
+
+Serves the same page as app.py from a single aiohttp event loop, plus a
+WebSocket at /ws. Each connected page keeps one socket open: control
+messages stream in over it without any per-request HTTP setup, and state
+changes are pushed to every connected client, so the page does not poll.
+
+Messages from the page are JSON objects:
+
+    {"cmd": "pattern", "name": "colorWipe", "params": {"rgb": [255, 0, 0]}}
+    {"cmd": "params", "params": {"delay_ms": 20}}
+    {"cmd": "timeline", "segments": [...], "loop": true}  # See sequencer.py
+
+"pattern" and "timeline" take an optional "transition", e.g.
+{"kind": "wipe", "seconds": 1.5} (see transitions.py), in place of the
+daemon's default.
+
+An optional "id" asks for a {"type": "reply", "id": ..., "status": "ok"}
+answer; errors are always answered. The server pushes
+{"type": "state", ...} messages in the same shape as /get_state.
+
+/preview streams the frames the strip is showing as binary messages: a
+little-endian uint32 frame number and uint16 pixel count, then one RGB byte
+triple per pixel. ``?pixels=N`` averages the strip down to at most N
+pixels. Each client holds only the newest frame, so a slow one skips frames
+rather than queueing them, and the render loop never waits on the web tier.
+
+    python async_app.py    # listens on PILED_BIND, default 0.0.0.0:8080
+'''
+import asyncio
+import json
+import os
+import struct
+
+import jinja2
+import numpy as np
+from aiohttp import web, WSMsgType
+
+import led_daemon
+import metrics
+import profiler
+import registry
+import sequencer
+from led_daemon import LEDClient
+from shared_state import StateReader, ui_state
+from transitions import Transition
+
+BIND = os.environ.get("PILED_BIND", "0.0.0.0:8080")
+STATE_POLL_S = 0.005  # How often shared memory is checked for changes to push
+STATS_INTERVAL_S = 1.0  # Frame counters and fps change every frame, so push those at most this often
+PREVIEW_FPS = 30
+PREVIEW_HEADER = struct.Struct("<IH")
+
+# Endpoint names used by url_for in the templates, as in app.py
+ROUTES = {"index": "/", "get_state": "/get_state", "list_patterns": "/patterns", "websocket": "/ws",
+          "preview": "/preview", "metrics": "/metrics", "profile": "/profile"}
+# Fields of the pushed state that only change when someone changes the strip
+CONTROL_FIELDS = ("R", "G", "B", "delay_ms", "brightness", "current_pattern")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def url_for(endpoint, filename=None):
+    if endpoint == "static":
+        return "/static/" + filename
+    return ROUTES[endpoint]
+
+
+def encode_frame(frames, packed, pixels=None):
+    '''Encode a packed frame for /preview, averaged down to at most `pixels` pixels.'''
+    rgb = np.stack([packed >> 16, packed >> 8, packed], axis=-1) & 255
+    if pixels and pixels < len(rgb):
+        starts = np.arange(pixels) * len(rgb) // pixels
+        counts = np.diff(np.append(starts, len(rgb)))
+        rgb = np.add.reduceat(rgb, starts) // counts[:, None]
+    return PREVIEW_HEADER.pack(frames & 0xFFFFFFFF, len(rgb)) + rgb.astype(np.uint8).tobytes()
+
+
+class PreviewClient:
+    '''
+    One /preview socket. Only the newest frame is held: a frame that arrives
+    while the previous one is still waiting to be sent replaces it.
+    '''
+
+    def __init__(self, ws, pixels):
+        self.ws = ws
+        self.pixels = pixels
+        self.frame = None
+        self.frame_number = None  # Of the last frame offered
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, frame):
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame = frame
+        self.ready.set()
+
+    async def send_frames(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            frame, self.frame = self.frame, None
+            try:
+                await self.ws.send_bytes(frame)
+            except ConnectionResetError:
+                return  # The socket handler notices the close and cleans up
+            self.sent += 1
+
+
+class ControlServer:
+
+    def __init__(self, led, state):
+        self.led = led
+        self.state = state
+        self.sockets = set()
+        self.previews = set()
+        self.last_state = None
+        self.templates = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(HERE, "templates")),
+                                            autoescape=True)
+        self.templates.globals["url_for"] = url_for
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_get("/get_state", self.get_state)
+        app.router.add_get("/patterns", self.list_patterns)
+        app.router.add_get("/ws", self.websocket)
+        app.router.add_get("/preview", self.preview)
+        app.router.add_get("/metrics", self.get_metrics)
+        app.router.add_get("/profile", self.get_profile)
+        app.router.add_get("/profile/start", self.start_profile)
+        app.router.add_get("/profile/stop", self.stop_profile)
+        app.router.add_static("/static", os.path.join(HERE, "static"))
+        app.cleanup_ctx.append(self._background)
+        return app
+
+    async def index(self, request):
+        page = self.templates.get_template("index.html").render(ws_url=ROUTES["websocket"],
+                                                                  preview_url=ROUTES["preview"])
+        return web.Response(text=page, content_type="text/html")
+
+    async def get_state(self, request):
+        try:
+            return web.json_response(ui_state(self.state.read()))
+        except (FileNotFoundError, TimeoutError):
+            return web.json_response({"status": "error", "message": "LED daemon is not running"}, status=503)
+
+    async def get_metrics(self, request):
+        try:
+            text = metrics.prometheus(self.state.read_metrics(), self.state.read())
+        except (FileNotFoundError, TimeoutError):
+            return web.Response(text="LED daemon is not running\n", status=503)
+        return web.Response(text=text, headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    async def start_profile(self, request):
+        '''Profile the render loop for ?seconds=N, with ?allocations=1 to trace allocations too.'''
+        try:
+            seconds = float(request.query.get("seconds", 10))
+        except ValueError:
+            raise web.HTTPBadRequest(text="seconds must be a number")
+        return await self._profile_command(action="start", seconds=seconds,
+                                           allocations=request.query.get("allocations") in ("1", "true"))
+
+    async def stop_profile(self, request):
+        return await self._profile_command(action="stop")
+
+    async def _profile_command(self, **fields):
+        # request() waits for the daemon's reply, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            reply = await loop.run_in_executor(None, lambda: self.led.request("profile", **fields))
+        except OSError:
+            return web.json_response({"status": "error", "message": "LED daemon is not running"}, status=503)
+        return web.json_response(reply, status=200 if reply["status"] == "ok" else 400)
+
+    async def get_profile(self, request):
+        '''The last profile: ?format=report (default) or ?format=collapsed for flamegraph tools.'''
+        extension = ".folded" if request.query.get("format") == "collapsed" else ".txt"
+        try:
+            with open(profiler.PROFILE_PATH + extension) as f:
+                return web.Response(text=f.read())
+        except FileNotFoundError:
+            return web.Response(text="No profile yet, or one is still running\n", status=404)
+
+    async def list_patterns(self, request):
+        return web.json_response(registry.describe())
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            if self.last_state is not None:
+                await ws.send_str(json.dumps(dict(self.last_state, type="state")))
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                reply = self.handle(msg.data)
+                if reply is not None:
+                    await ws.send_str(json.dumps(reply))
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    def handle(self, data):
+        '''Validate one control message and forward it to the daemon. Returns the reply, if one is due.'''
+        command = {}
+        try:
+            command = json.loads(data)
+            cmd = command["cmd"]
+            transition = command.get("transition")
+            if transition is not None:
+                transition = Transition.parse(transition).describe()  # Validate before the daemon sees it
+            if cmd == "pattern":
+                name = command["name"]
+                self.led.start_pattern(name, transition, **registry.get(name).bind(**command.get("params", {})))
+            elif cmd == "params":
+                self.led.set_params(**registry.parse_live(command.get("params", {})))
+            elif cmd == "timeline":
+                sequencer.Timeline.from_json(command)  # Validate before the daemon compiles it
+                self.led.play_timeline(command["segments"], command.get("loop", False), transition)
+            else:
+                raise ValueError(f"Unknown command {cmd!r}")
+            reply = {"type": "reply", "status": "ok"}
+        except OSError:
+            reply = {"type": "reply", "status": "error", "message": "LED daemon is not running"}
+        except (ValueError, TypeError, KeyError) as e:
+            reply = {"type": "reply", "status": "error", "message": str(e)}
+        if isinstance(command, dict) and "id" in command:
+            reply["id"] = command["id"]
+        elif reply["status"] == "ok":
+            return None
+        return reply
+
+    async def preview(self, request):
+        try:
+            pixels = int(request.query.get("pixels", 0))
+        except ValueError:
+            raise web.HTTPBadRequest(text="pixels must be an integer")
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        client = PreviewClient(ws, pixels)
+        sender = asyncio.create_task(client.send_frames())
+        self.previews.add(client)
+        try:
+            async for msg in ws:
+                pass  # Nothing to receive; this just notices when the client goes away
+        finally:
+            self.previews.discard(client)
+            sender.cancel()
+        return ws
+
+    async def _background(self, app):
+        tasks = [asyncio.create_task(self.push_state()), asyncio.create_task(self.push_frames())]
+        yield
+        for task in tasks:
+            task.cancel()
+
+    async def push_frames(self):
+        '''
+        Offer each new frame to every preview client that does not have it
+        yet, encoded once per requested size. The daemon only publishes
+        frames that changed, so a client that joins during a still frame
+        gets that one.
+        '''
+        while True:
+            await asyncio.sleep(1 / PREVIEW_FPS)
+            if not self.previews:
+                continue
+            try:
+                frames, packed = self.state.read_frame()
+            except (FileNotFoundError, TimeoutError):
+                continue
+            encoded = {}
+            for client in list(self.previews):
+                if client.frame_number == frames:
+                    continue
+                client.frame_number = frames
+                if client.pixels not in encoded:
+                    encoded[client.pixels] = encode_frame(frames, packed, client.pixels)
+                client.offer(encoded[client.pixels])
+
+    async def push_state(self):
+        '''Push the state to every client when it changes, and the frame counters once a second.'''
+        loop = asyncio.get_running_loop()
+        last_stats = 0.0
+        while True:
+            await asyncio.sleep(STATE_POLL_S)
+            if not self.sockets:
+                continue
+            try:
+                state = ui_state(self.state.read())
+            except (FileNotFoundError, TimeoutError):
+                continue
+            changed = (self.last_state is None
+                       or any(state[key] != self.last_state[key] for key in CONTROL_FIELDS))
+            now = loop.time()
+            if changed or now - last_stats >= STATS_INTERVAL_S:
+                self.last_state = state
+                last_stats = now
+                await self.broadcast(json.dumps(dict(state, type="state")))
+
+    async def broadcast(self, message):
+        sockets = list(self.sockets)
+        results = await asyncio.gather(*(ws.send_str(message) for ws in sockets), return_exceptions=True)
+        for ws, result in zip(sockets, results):
+            if isinstance(result, Exception):
+                self.sockets.discard(ws)  # Gone; its handler cleans up
+
+
+def main():
+    led_daemon.spawn()
+    server = ControlServer(LEDClient(), StateReader())
+    host, port = BIND.rsplit(":", 1)
+    web.run_app(server.make_app(), host=host, port=int(port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+'''
+Streaming audio analysis for the audio-reactive patterns.
+
+An Analyzer thread reads mono 16-bit PCM in blocks of HOP samples, and
+for each block takes a Hann-windowed FFT of the last WINDOW samples. It
+sums the power into BANDS log-spaced bands between MIN_HZ and MAX_HZ. The
+bands are then scaled to 0-1 against a slowly decaying peak, so quiet and
+loud music both fill the range, but hiss does not. Each result goes into
+a BandRing. The render loop reads the newest entry from there without
+taking a lock or waiting for the audio thread.
+
+PILED_AUDIO picks the source:
+
+- "alsa" or "alsa:<device>" captures from ALSA. This needs pyalsaaudio;
+- a path to a .wav file, raw s16le mono PCM at AUDIO_RATE, or a named pipe
+  of it (e.g. ``mkfifo /tmp/piled.pcm`` fed by
+  ``ffmpeg -re -i song.mp3 -f s16le -ac 1 -ar 44100 - > /tmp/piled.pcm``).
+  Files are paced to real time and loop; a pipe is read as fast as its
+  writer feeds it.
+
+It defaults to "alsa" if pyalsaaudio is installed. Without a usable source
+the bands stay at zero, so the patterns render darkness rather than stop.
+
+Audio to light latency is the capture block (HOP / AUDIO_RATE, 5.8 ms),
+plus the analysis (well under 1 ms), plus the wait for the next tick (up to
+a frame, 16.7 ms at 60 fps), plus the show(). That comes to about 15 ms on
+average and under 30 ms on a 300-pixel strip. Each entry carries its
+capture time, so the patterns' latency can be measured:
+
+    python audio.py song.wav    # print the bands and their age as they arrive
+'''
+import contextlib
+import os
+import stat
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+# What a source that cannot be opened or read raises
+_SOURCE_ERRORS = (OSError, ValueError, EOFError, wave.Error) + ((alsaaudio.ALSAAudioError,) if alsaaudio else ())
+
+AUDIO_SOURCE = os.environ.get("PILED_AUDIO", "alsa" if alsaaudio is not None else "")
+AUDIO_RATE = 44100
+WINDOW = 1024  # Samples per FFT, 23 ms
+HOP = 256  # Samples per block read, and between FFTs
+BANDS = 16
+MIN_HZ = 40.0
+MAX_HZ = 16000.0
+RANGE_DB = 50.0  # Levels this far below the running peak read as 0
+MIN_PEAK_DB = -40.0  # The running peak never drops below this, relative to a full-scale sine
+PEAK_DECAY_DB_S = 6.0  # How fast the running peak falls back after a loud passage
+RING_SLOTS = 8
+
+
+class BandRing:
+    '''
+    Single-writer ring of band levels, read without locks.
+
+    The writer fills the slot after the newest, then bumps the count.
+    Readers copy the newest slot and check the count afterwards. If the
+    writer has wrapped around onto that slot in the meantime, they retry.
+    '''
+
+    def __init__(self, bands=BANDS, slots=RING_SLOTS):
+        self.levels = np.zeros((slots, bands), dtype=np.float32)
+        self.captured_ns = np.zeros(slots, dtype=np.int64)
+        self.count = 0  # Entries written so far; a plain int, so reading it is atomic
+
+    def push(self, levels, captured_ns):
+        slot = self.count % len(self.levels)
+        self.levels[slot] = levels
+        self.captured_ns[slot] = captured_ns
+        self.count += 1
+
+    def latest(self, out):
+        '''
+        Copy the newest levels into out. Returns their monotonic capture
+        time in ns, or 0 if nothing has been written yet.
+        '''
+        slots = len(self.levels)
+        while True:
+            count = self.count
+            if not count:
+                out[:] = 0
+                return 0
+            slot = (count - 1) % slots
+            out[:] = self.levels[slot]
+            captured_ns = int(self.captured_ns[slot])
+            if self.count - count < slots - 1:
+                return captured_ns
+            # The writer lapped the ring while we copied; the slot may be torn
+
+
+def _band_edges(rate):
+    '''FFT bin index where each band starts, plus the end of the last, one bin per band at least.'''
+    freqs = np.fft.rfftfreq(WINDOW, 1 / rate)
+    edges = np.searchsorted(freqs, np.geomspace(MIN_HZ, min(MAX_HZ, rate / 2), BANDS + 1))
+    edges = np.maximum(edges, np.arange(BANDS + 1) + edges[0])  # Low bands can be narrower than a bin
+    return np.minimum(edges, len(freqs))
+
+
+class Analyzer:
+    '''
+    Background thread turning an audio source into band levels in a BandRing.
+
+    Parameters:
+    source: str
+        As for PILED_AUDIO
+    '''
+
+    def __init__(self, source=AUDIO_SOURCE):
+        self.source = source
+        self.ring = BandRing()
+        self.rate = AUDIO_RATE
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="audio", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Ask the thread to stop. It finishes after the read it is blocked in.'''
+        self._stop.set()
+
+    def latest(self, out):
+        return self.ring.latest(out)
+
+    def _run(self):
+        if not self.source:
+            return  # No source configured; the bands stay at zero
+        try:
+            self._analyze(self._blocks())
+        except _SOURCE_ERRORS as e:
+            self.error = f"{self.source}: {e}"
+            print(f"Audio source unavailable, {self.error}", file=sys.stderr)
+
+    def _blocks(self):
+        '''
+        Open the source, setting self.rate, and return a generator of
+        (int16 samples, monotonic capture time) blocks of HOP samples.
+        '''
+        if self.source == "alsa" or self.source.startswith("alsa:"):
+            if alsaaudio is None:
+                raise ValueError("ALSA capture needs pyalsaaudio")
+            pcm = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL,
+                                device=self.source.partition(":")[2] or "default", channels=1,
+                                rate=self.rate, format=alsaaudio.PCM_FORMAT_S16_LE, periodsize=HOP)
+            return self._alsa_blocks(pcm)
+        pipe = stat.S_ISFIFO(os.stat(self.source).st_mode)
+        if self.source.endswith(".wav"):
+            f = wave.open(self.source, "rb")
+            if f.getsampwidth() != 2:
+                f.close()
+                raise ValueError("only 16-bit WAV files are supported")
+            self.rate = f.getframerate()
+            return self._file_blocks(f, f.readframes, f.rewind, f.getnchannels(), pipe)
+        f = open(self.source, "rb")
+        return self._file_blocks(f, lambda frames: f.read(frames * 2), lambda: f.seek(0), 1, pipe)
+
+    def _alsa_blocks(self, pcm):
+        try:
+            while not self._stop.is_set():
+                length, data = pcm.read()
+                if length > 0:
+                    yield np.frombuffer(data, dtype="<i2"), time.monotonic_ns()
+        finally:
+            pcm.close()
+
+    def _file_blocks(self, f, read, rewind, channels, pipe):
+        start_ns, played = time.monotonic_ns(), 0
+        try:
+            while not self._stop.is_set():
+                data = read(HOP)
+                if len(data) < HOP * 2 * channels:
+                    if pipe:
+                        if not data:
+                            return  # The writer went away
+                        continue  # A partial block; drop it rather than stall
+                    rewind()
+                    continue
+                samples = np.frombuffer(data, dtype="<i2")
+                if channels > 1:
+                    samples = samples.reshape(-1, channels).mean(axis=1)
+                if not pipe:
+                    # Pace a file to real time, as if it were being captured
+                    played += HOP
+                    delay = start_ns + played * 1e9 / self.rate - time.monotonic_ns()
+                    if delay > 0:
+                        time.sleep(delay / 1e9)
+                yield samples, time.monotonic_ns()
+        finally:
+            f.close()
+
+    def _analyze(self, blocks):
+        window = np.hanning(WINDOW)
+        # Scaled so a full-scale sine puts a power of 1 (0 dB) into its bin
+        window = (window / (32768 * window.sum() / 2)).astype(np.float32)
+        edges = _band_edges(self.rate)
+        samples = np.zeros(WINDOW, dtype=np.float32)
+        windowed = np.empty(WINDOW, dtype=np.float32)
+        levels = np.empty(BANDS, dtype=np.float32)
+        peak_db = -np.inf
+        decay_db = PEAK_DECAY_DB_S * HOP / self.rate
+        for block, captured_ns in blocks:
+            k = min(len(block), WINDOW)  # ALSA may hand over more than a period after an overrun
+            samples[:-k] = samples[k:]
+            samples[-k:] = block[-k:]
+            np.multiply(samples, window, out=windowed)
+            power = np.abs(np.fft.rfft(windowed)) ** 2
+            # Summed, so pink-ish music comes out roughly level. The top band stops at its edge, not at Nyquist
+            levels[:] = np.add.reduceat(power[:edges[-1]], edges[:-1])
+            np.log10(levels + 1e-12, out=levels)
+            levels *= 10
+            peak_db = max(float(levels.max()), peak_db - decay_db, MIN_PEAK_DB)
+            levels -= peak_db - RANGE_DB
+            levels /= RANGE_DB
+            np.clip(levels, 0, 1, out=levels)
+            self.ring.push(levels, captured_ns)
+
+
+_analyzer = None
+_listeners = 0
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def listen():
+    '''
+    The shared Analyzer, running for as long as any pattern is inside this
+    context. Patterns hold it around their frame loop, so the audio source
+    is only open while an audio-reactive pattern is running.
+    '''
+    global _analyzer, _listeners
+    with _lock:
+        if _listeners == 0:
+            _analyzer = Analyzer()
+            _analyzer.start()
+        _listeners += 1
+        analyzer = _analyzer
+    try:
+        yield analyzer
+    finally:
+        with _lock:
+            _listeners -= 1
+            if _listeners == 0:
+                _analyzer.stop()
+                _analyzer = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        AUDIO_SOURCE = sys.argv[1]
+    analyzer = Analyzer(AUDIO_SOURCE)
+    analyzer.start()
+    levels = np.zeros(BANDS, dtype=np.float32)
+    shown = 0
+    try:
+        while analyzer.error is None:
+            time.sleep(1 / 30)
+            count = analyzer.ring.count
+            if count == shown:
+                continue
+            shown = count
+            captured_ns = analyzer.latest(levels)
+            bars = "".join(" .:-=+*#%@"[int(level * 9.99)] for level in levels)
+            print(f"|{bars}| {(time.monotonic_ns() - captured_ns) / 1e6:5.1f} ms", flush=True)
+    except KeyboardInterrupt:
+        pass
+    analyzer.stop()
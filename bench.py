@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''
+Headless benchmark for LED patterns.
+
+Runs every pattern on the mock strip for a fixed number of frames with the
+frame clock stubbed out (frame i is rendered for t = i / fps, with no
+sleeping), and reports throughput, per-frame latency percentiles and
+Python allocations per frame. Each frame covers the pattern step plus the
+commit and show() on the mock strip. It then switches patterns from another
+thread while the real render loop runs, and exits non-zero if any switch
+took longer than one frame.
+
+    python bench.py --frames 2000 rainbowCycle theaterChaseRainbow
+'''
+import os
+os.environ.setdefault("PILED_STRIP", "mock")
+
+import argparse
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from led import LED, LED_FPS
+from registry import PATTERNS
+from transitions import Transition
+
+
+def start(led, name, seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+    return led.play(name)  # With the registry's default params
+
+
+def step(led, i):
+    led.renderer.render_frame(i * led.renderer.period_ns)
+
+
+def time_pattern(led, name, frames, seed=0):
+    '''Return per-frame latencies in nanoseconds.'''
+    start(led, name, seed)
+    latencies = np.empty(frames, dtype=np.int64)
+    for i in range(frames):
+        t0 = time.perf_counter_ns()
+        step(led, i)
+        latencies[i] = time.perf_counter_ns() - t0
+    return latencies
+
+
+def count_allocations(led, name, frames, seed=0):
+    '''Return (bytes, blocks) allocated per frame, from a separate traced run.'''
+    start(led, name, seed)
+    step(led, 0)  # Let lazily created state settle before measuring
+    tracemalloc.start()
+    total_bytes = 0
+    try:
+        for i in range(1, frames + 1):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            step(led, i)
+            total_bytes += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    blocks_before = sys.getallocatedblocks()
+    for i in range(frames + 1, 2 * frames + 1):
+        step(led, i)
+    blocks = sys.getallocatedblocks() - blocks_before
+    return total_bytes / frames, blocks / frames
+
+
+def switch_latency(led, name, switches):
+    '''
+    Return switch latencies in nanoseconds: the time from cancelling a
+    running pattern on another thread to the render loop closing it.
+    Runs the real render loop, with the mock strip's wire time simulated.
+    '''
+    for strip in led.strips:
+        strip.wire_time = True
+    runner = threading.Thread(target=led.renderer.run)
+    latencies = []
+    try:
+        token = start(led, name)
+        runner.start()
+        for _ in range(switches):
+            time.sleep(random.uniform(1, 3) / LED_FPS)  # Land somewhere inside a frame
+            next_token = start(led, name)
+            if not token.wait(timeout=1.0):
+                raise RuntimeError(f"{name} did not stop within 1 s")
+            latencies.append(token.closed_ns - token.cancelled_ns)
+            token = next_token
+    finally:
+        led.stop()
+        runner.join()
+        for strip in led.strips:
+            strip.wire_time = False
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LED patterns on the mock strip")
+    parser.add_argument("patterns", nargs="*", default=list(PATTERNS), help="Patterns to run (default: all)")
+    parser.add_argument("--frames", type=int, default=1000, help="Frames to render per pattern")
+    parser.add_argument("--alloc-frames", type=int, default=200, help="Frames to trace for allocations")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random patterns, so runs with the same seed render the same frames")
+    parser.add_argument("--switches", type=int, default=20,
+                        help="Pattern switches to time in real time (0 to skip)")
+    args = parser.parse_args()
+    unknown = [name for name in args.patterns if name not in PATTERNS]
+    if unknown:
+        parser.error(f"unknown patterns: {', '.join(unknown)}")
+
+    led = LED()
+    led.transition = Transition(seconds=0)  # Time each pattern on its own, and switches as hard cuts
+    period_us = led.renderer.period_ns / 1e3
+    print(f"{'pattern':<22}{'fps':>10}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'max us':>10}"
+          f"{'alloc B/f':>12}{'blocks/f':>10}{'switch us':>11}")
+    late = []
+    for name in args.patterns:
+        latencies = time_pattern(led, name, args.frames, args.seed)
+        alloc_bytes, blocks = count_allocations(led, name, args.alloc_frames, args.seed)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) / 1e3
+        fps = len(latencies) / (latencies.sum() / 1e9)
+        switch_us = float("nan")
+        if args.switches:
+            switch_us = switch_latency(led, name, args.switches).max() / 1e3
+            if switch_us > period_us:
+                late.append(name)
+        print(f"{name:<22}{fps:>10.0f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{latencies.max() / 1e3:>10.1f}"
+              f"{alloc_bytes:>12.0f}{blocks:>10.2f}{switch_us:>11.0f}")
+    if late:
+        print(f"Switch latency exceeded one frame ({period_us:.0f} us) for: {', '.join(late)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
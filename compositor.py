@@ -0,0 +1,116 @@
+'''
+Sprite compositor for patterns with overlapping sub-animations.
+
+A pattern that runs several sub-animations at once (shots, explosions,
+drips) adds them to a Compositor as Sprite objects instead of having each
+one write to the framebuffer. Every frame the compositor advances each
+sprite to the frame time, blends them over a persistent base layer and
+writes the result into the framebuffer in one go, so there is a single
+writer and the render loop still calls show() exactly once per frame, however
+many sprites are active.
+'''
+import numpy as np
+
+
+def _over(dst, src):
+    dst[...] = src
+
+
+def _max(dst, src):
+    np.maximum(dst, src, out=dst)
+
+
+def _add(dst, src):
+    # Saturating add without leaving uint8
+    dst += np.minimum(src, 255 - dst)
+
+
+BLEND_MODES = {"over": _over, "max": _max, "add": _add}
+
+
+class Sprite:
+    '''
+    A sub-animation owned by a Compositor.
+
+    update(t) advances the sprite to frame time t (seconds) and returns False
+    once it has finished. draw(paint) paints the sprite's current pixels by
+    calling ``paint(key, rgb)`` with a slice or index array and a color or
+    array of colors. A finished sprite is drawn one last time into the base
+    layer, so whatever it leaves behind stays lit until the base is cleared.
+    '''
+
+    def update(self, t):
+        return False
+
+    def draw(self, paint):
+        pass
+
+
+class Compositor:
+    '''
+    Blend sprites over a base layer into a framebuffer.
+
+    Parameters:
+    fb: FrameBuffer instance
+    blend: str
+        How sprites combine with what is under them: "over" (last drawn
+        wins), "max" (per-channel lighten) or "add" (saturating add)
+    '''
+
+    def __init__(self, fb, blend="max"):
+        self.fb = fb
+        self.base = np.zeros_like(fb.pixels)
+        self.sprites = []
+        self._queued = []
+        self._out = np.zeros_like(fb.pixels)
+        self._blend = BLEND_MODES[blend]
+        self._paint_out = lambda key, rgb: self._paint(self._out, key, rgb)
+        self._paint_base = lambda key, rgb: self._paint(self.base, key, rgb)
+
+    def add(self, sprite, delay_ms=0):
+        '''Add a sprite, starting it on the first frame at least delay_ms from now.'''
+        self._queued.append((delay_ms, sprite))
+        return sprite
+
+    def clear(self):
+        '''Drop every sprite and blank the base layer.'''
+        self.base[:] = 0
+        self.sprites.clear()
+        self._queued.clear()
+
+    @property
+    def active(self):
+        return bool(self.sprites or self._queued)
+
+    def _paint(self, target, key, rgb):
+        region = target[key]
+        self._blend(region, np.asarray(rgb, dtype=np.uint8))
+        target[key] = region  # Index arrays give a copy rather than a view
+
+    def render(self, t):
+        '''Advance every sprite to t and write the composited frame into the framebuffer.'''
+        for delay_ms, sprite in self._queued:
+            self.sprites.append((t + delay_ms / 1000.0, sprite))
+        self._queued.clear()
+
+        remaining = []
+        for start, sprite in self.sprites:
+            if t >= start and not sprite.update(t):
+                sprite.draw(self._paint_base)
+            else:
+                remaining.append((start, sprite))
+        self.sprites = remaining
+
+        self._out[:] = self.base
+        for start, sprite in remaining:
+            if t >= start:
+                sprite.draw(self._paint_out)
+        self.fb[:] = self._out
+
+    def play(self, t):
+        '''Render frames from t until every sprite has finished. Returns the time of the last frame.'''
+        while True:
+            self.render(t)
+            if not self.active:
+                return t
+            t = yield
@@ -0,0 +1,87 @@
+'''
+Coalescing queue between the daemon's control socket and the renderer.
+
+Dragging a slider or a color picker sends a storm of small commands. The
+daemon pushes every command it receives into a CommandQueue and takes at
+most one batch out per frame, so the renderer only ever sees:
+
+- one merged params update per frame, last write wins per parameter;
+- at most one pattern switch per switch interval. A switch that arrives
+  sooner waits, and is dropped if a newer one replaces it before it starts.
+  Params sent after a waiting switch are merged into it.
+
+The receive thread also asks due() before waking the render loop, and
+records each wake with woke(), so a storm cannot make it render more than
+one early frame per window. An isolated command is always due, however
+recently the last regular frame was rendered.
+'''
+import time
+
+
+class CommandQueue:
+    '''
+    Parameters:
+    window_ms: float
+        Minimum time between batches that wake the render loop early
+    switch_interval_ms: float
+        Minimum time between two pattern switches
+    '''
+
+    def __init__(self, window_ms=10, switch_interval_ms=250):
+        self.window_ns = int(window_ms * 1e6)
+        self.switch_interval_ns = int(switch_interval_ms * 1e6)
+        self.pattern = None  # (name, params, transition) waiting to be started
+        self.params = {}  # Merged update for the running pattern
+        self.last_wake_ns = None
+        self.last_switch_ns = None
+        self.received = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def due(self, now_ns=None):
+        '''True if a command arriving now may wake the render loop.'''
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        return self.last_wake_ns is None or now_ns - self.last_wake_ns >= self.window_ns
+
+    def woke(self, now_ns=None):
+        '''Record that a command has just woken the render loop early.'''
+        self.last_wake_ns = time.monotonic_ns() if now_ns is None else now_ns
+
+    def push_pattern(self, name, params, transition=None):
+        '''Queue a pattern switch. params must already be validated and complete.'''
+        self.received += 1
+        if self.pattern is not None:
+            self.dropped += 1  # Replaced before it was ever shown
+        self.pattern = (name, dict(params), transition)
+
+    def push_params(self, params):
+        '''Queue a params update. A later update to the same parameter wins.'''
+        self.received += 1
+        merged = bool(self.params)
+        for key, value in params.items():
+            if self.pattern is not None and key in self.pattern[1]:
+                # The update comes after the waiting switch, so it belongs to the new pattern
+                merged = True
+                self.pattern[1][key] = value
+            else:
+                self.params[key] = value
+        self.merged += merged
+
+    def take(self, now_ns=None):
+        '''
+        Return (pattern, params) to apply on this frame, either of which may
+        be None. params were sent before the pattern, so apply them first.
+        '''
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        pattern = None
+        if self.pattern is not None and (self.last_switch_ns is None
+                                         or now_ns - self.last_switch_ns >= self.switch_interval_ns):
+            pattern, self.pattern = self.pattern, None
+            self.last_switch_ns = now_ns
+        params, self.params = self.params or None, {}
+        return pattern, params
+
+    def counts(self):
+        return {"received": self.received, "merged": self.merged, "dropped": self.dropped}
@@ -0,0 +1,274 @@
+import ctypes
+import numpy as np
+
+from layout import Layout
+
+try:
+    import _rpi_ws281x as ws
+except ImportError:
+    ws = None
+
+# WS2812 power model: each channel draws about 20 mA at full level and each
+# pixel about 1 mA when dark.
+MILLIAMPS_PER_CHANNEL = 20.0
+IDLE_MILLIAMPS = 1.0
+
+_SHIFTS = np.array([[16], [8], [0]], dtype=np.uint32)
+_CHANNEL_OFFSETS = np.array([0, 256, 512], dtype=np.int16)
+_WHOLE_FRAME = slice(None)
+
+
+class FrameBuffer:
+    '''
+    Contiguous RGB framebuffer that patterns draw into.
+
+    Pixels are held as a uint8 array of shape (N, 3). Patterns write whole
+    slices or index arrays at once, e.g. ``fb[10:20] = (255, 0, 0)``, and the
+    finished frame is pushed to the strip with a single ``commit`` call.
+
+    Writes should go through ``fb[...] = ...``, ``fill`` or ``clear`` (not
+    ``fb.pixels`` directly), and an index array should not repeat an index:
+    the framebuffer keeps a running per-channel sum of output levels as
+    pixels are written, so the power limiter never rescans the frame.
+
+    Writes also widen a dirty range. ``pack_changes`` compares only that
+    range with the last packed frame and repacks only the span that really
+    changed, so a pattern that redraws the same pixels, or none, costs no
+    commit or show() at all.
+
+    With ``dither`` the output stage works in 8.8 fixed point: the output
+    table keeps gamma and brightness unrounded, and each pixel carries the
+    fraction it could not show over to its next frame (temporal dithering),
+    so the average light out over a few frames is exact. Dark gamma-corrected
+    levels and dimmed fades no longer band or round down to off. A frame
+    with fractional levels is repacked and shown on every commit, as that
+    is what moves the fractions out.
+
+    ``layout`` is where the pixels physically are (see layout.py), for
+    patterns that draw in space. It defaults to a straight line.
+    '''
+
+    def __init__(self, num_pixels, max_milliamps=None, dither=False, layout=None):
+        if layout is not None and len(layout) != num_pixels:
+            raise ValueError(f"The layout has {len(layout)} pixels, not {num_pixels}")
+        self.layout = Layout.line(num_pixels) if layout is None else layout
+        self.pixels = np.zeros((num_pixels, 3), dtype=np.uint8)
+        self._packed = np.zeros(num_pixels, dtype=np.uint32)
+        self.max_milliamps = max_milliamps
+        self.dither = dither
+        self._fine = np.zeros((num_pixels, 3), dtype=np.uint16)
+        # Start every pixel's carried fraction at a different phase, so a
+        # level between two steps does not make the whole strip blink in step
+        self._residual = np.random.default_rng(0).integers(0, 256, (num_pixels, 3), dtype=np.uint16)
+        self._dithering = False  # Whether the last pack had fractional levels to carry
+        self._ones = np.ones(num_pixels, dtype=np.float32)
+        self.scale = 1.0
+        self._packed_pixels = np.zeros_like(self.pixels)  # The frame as of the last pack
+        self._packed_lut = None
+        self._dirty = (0, num_pixels)
+        self.set_output_table(np.tile(np.arange(256, dtype=np.uint8), (3, 1)))
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def __getitem__(self, key):
+        return self.pixels[key]
+
+    def __setitem__(self, key, rgb):
+        if isinstance(key, slice) and key == _WHOLE_FRAME:
+            self.pixels[:] = rgb
+            self.channel_sums = self._level_sums(self.pixels)
+            self._dirty = (0, len(self.pixels))
+            return
+        self.channel_sums -= self._level_sums(self.pixels[key])
+        self.pixels[key] = rgb
+        self.channel_sums += self._level_sums(self.pixels[key])
+        self._mark(key)
+
+    def fill(self, rgb):
+        self.pixels[:] = rgb
+        self.channel_sums = self._level_sums(self.pixels[:1]) * len(self.pixels)
+        self._dirty = (0, len(self.pixels))
+
+    def clear(self):
+        self.pixels[:] = 0
+        self.channel_sums = self._levels[:, 0].astype(np.float64) * len(self.pixels)
+        self._dirty = (0, len(self.pixels))
+
+    def _mark(self, key):
+        '''Widen the dirty range to cover the pixels key addresses.'''
+        n = len(self.pixels)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            lo, hi = (start, stop) if step > 0 else (stop + 1, start + 1)
+        elif isinstance(key, (int, np.integer)):
+            lo = key % n
+            hi = lo + 1
+        elif isinstance(key, np.ndarray) and key.dtype.kind in "iu" and key.size:
+            lo, hi = int(key.min()), int(key.max()) + 1
+            if lo < 0:
+                lo, hi = 0, n  # Negative indices could be anywhere
+        else:
+            lo, hi = 0, n
+        dirty_lo, dirty_hi = self._dirty
+        if lo < hi:
+            self._dirty = (min(dirty_lo, lo), max(dirty_hi, hi))
+
+    def _level_sums(self, block):
+        '''Per-channel sums of output levels for a block of pixels.'''
+        # One gather into the flattened (3 * 256) table, offset per channel, then
+        # a matrix-vector product, which is much faster than a strided sum(axis=0).
+        # float32 is exact here: a channel sum only reaches 2**24 past 65k pixels.
+        levels = self._levels_flat.take(block.reshape(-1, 3) + _CHANNEL_OFFSETS)
+        return self._ones[:len(levels)] @ levels
+
+    def set_output_table(self, table):
+        '''
+        Set the (3, 256) per-channel lookup table (gamma, brightness, balance)
+        of output levels 0-255 applied on the way out. Without dithering the
+        table is rounded and stored pre-shifted into each channel's byte, so
+        packing and lookup are one gather per channel. With dithering its
+        fractions are kept, in 8.8 fixed point.
+        '''
+        levels = np.clip(np.asarray(table, dtype=np.float64), 0, 255)
+        self._levels = np.rint(levels).astype(np.uint8)
+        self._levels_flat = self._levels.ravel().astype(np.float32)
+        self._channel_lut = self._levels.astype(np.uint32) << _SHIFTS
+        self._fine_lut = np.rint(levels * 256).astype(np.uint16).ravel()
+        self._limited_lut = (None, None)
+        self.channel_sums = self._level_sums(self.pixels)  # Levels changed, so rescan once
+
+    def milliamps(self):
+        '''Estimated current draw of the frame as it will be sent, before limiting.'''
+        return (IDLE_MILLIAMPS * len(self.pixels)
+                + self.channel_sums.sum() * MILLIAMPS_PER_CHANNEL / 255.0)
+
+    def _output_lut(self):
+        '''The packing table for the current frame, dimmed by the power limiter if need be.'''
+        lut = self._fine_lut if self.dither else self._channel_lut
+        self.scale = 1.0
+        if self.max_milliamps is not None:
+            estimate = self.milliamps()
+            if estimate > self.max_milliamps:
+                # Only the lit part of the draw scales; scale the 768-entry table rather than the pixels
+                idle = IDLE_MILLIAMPS * len(self.pixels)
+                self.scale = max(self.max_milliamps - idle, 0) / (estimate - idle)
+                lut = self._limited(self.scale)
+        return lut
+
+    def _pack_span(self, lut, lo, hi):
+        pixels = self.pixels[lo:hi]
+        packed = self._packed[lo:hi]
+        self._packed_pixels[lo:hi] = pixels
+        if self.dither:
+            self._dither_span(lut, pixels, packed, lo, hi)
+            return
+        np.take(lut[0], pixels[:, 0], out=packed)
+        packed |= lut[1].take(pixels[:, 1])
+        packed |= lut[2].take(pixels[:, 2])
+
+    def _dither_span(self, lut, pixels, packed, lo, hi):
+        '''Pack a span through the 8.8 fixed point table, carrying each fraction over to the next frame.'''
+        fine = self._fine[lo:hi]
+        np.take(lut, pixels + _CHANNEL_OFFSETS, out=fine)
+        # Only called for the whole frame or, when nothing had fractions, the
+        # span that changed, so the span decides for the whole frame
+        self._dithering = bool(np.bitwise_and(fine, 0xFF).any())
+        residual = self._residual[lo:hi]
+        fine += residual  # At most 255 * 256 + 255, so this cannot overflow
+        np.bitwise_and(fine, 0xFF, out=residual)
+        fine >>= 8
+        packed[:] = fine[:, 0]
+        packed <<= 8
+        packed |= fine[:, 1]
+        packed <<= 8
+        packed |= fine[:, 2]
+
+    def pack(self):
+        '''Pack the whole frame into 0x00RRGGBB integers, the layout rpi_ws281x expects.'''
+        lut = self._output_lut()
+        self._pack_span(lut, 0, len(self.pixels))
+        self._packed_lut = lut
+        self._dirty = (len(self.pixels), 0)
+        return self._packed
+
+    def pack_changes(self):
+        '''
+        Repack only what changed since the last pack. Returns the (lo, hi)
+        span of pixels whose packed value may have changed, or None if the
+        packed frame is the same as before.
+        '''
+        lut = self._output_lut()
+        n = len(self.pixels)
+        if lut is not self._packed_lut or self._dithering:
+            # The table or the limiter's scale changed, so every pixel did,
+            # or there are fractions being dithered out, which moves them
+            lo, hi = 0, n
+            self._packed_lut = lut
+        else:
+            lo, hi = self._dirty
+            if lo >= hi:
+                return None
+            # Narrow the dirty range to the bytes that really differ
+            changed = np.flatnonzero(self.pixels[lo:hi].reshape(-1) != self._packed_pixels[lo:hi].reshape(-1))
+            if not len(changed):
+                self._dirty = (n, 0)
+                return None
+            lo, hi = lo + int(changed[0]) // 3, lo + int(changed[-1]) // 3 + 1
+        self._pack_span(lut, lo, hi)
+        self._dirty = (n, 0)
+        return lo, hi
+
+    @property
+    def packed(self):
+        '''The frame as last packed by pack() or commit().'''
+        return self._packed
+
+    def _limited(self, scale):
+        '''Output table dimmed by scale, cached while the scale holds steady.'''
+        step = int(scale * 1024)  # Quantize so a static frame reuses the same table
+        cached_step, lut = self._limited_lut
+        if step != cached_step:
+            if self.dither:
+                lut = (self._fine_lut.astype(np.uint32) * step >> 10).astype(np.uint16)
+            else:
+                lut = (self._levels.astype(np.uint32) * step >> 10) << _SHIFTS
+            self._limited_lut = (step, lut)
+        return lut
+
+    def commit(self, strip):
+        '''Copy the whole frame into the strip's LED array. Does not call show().'''
+        write_pixels(strip, self.pack())
+
+
+def _leds_address(strip):
+    '''Return the address of the ws2811 channel's LED array, or None if unavailable.'''
+    channel = getattr(strip, "_channel", None)
+    if ws is None or channel is None:
+        return None
+    try:
+        return int(ws.ws2811_channel_t_leds_get(channel))
+    except (TypeError, AttributeError):
+        return None
+
+
+def write_pixels(strip, packed, offset=0):
+    '''
+    Write packed colors into the strip, starting at pixel offset.
+
+    For a real rpi_ws281x PixelStrip this is one memmove into the channel's
+    LED array, and for the mock strip one copy into its ``leds`` array.
+    Other strips fall back to setPixelColor per pixel.
+    '''
+    address = _leds_address(strip)
+    if address:
+        n = min(len(packed), strip.numPixels() - offset)
+        ctypes.memmove(address + offset * packed.itemsize, packed.ctypes.data, n * packed.itemsize)
+        return
+    leds = getattr(strip, "leds", None)
+    if isinstance(leds, np.ndarray):
+        n = min(len(packed), len(leds) - offset)
+        leds[offset:offset + n] = packed[:n]
+        return
+    for i, color in enumerate(packed.tolist(), offset):
+        strip.setPixelColor(i, color)
@@ -0,0 +1,108 @@
+'''
+Physical layout of the pixels.
+
+A Layout describes the installation as segments of strip in wiring order.
+Each segment has a pixel count and runs in a straight line between two
+points, e.g. up one side of a door frame, across the top and down the
+other side. It is compiled once into arrays, so patterns never do
+per-pixel geometry:
+
+- ``x`` and ``y``: the position of every pixel, scaled to 0-1 across the
+  layout, so a pattern can draw in space, e.g. ``wheel_rgb(fb.layout.y * 255)``
+  for a rainbow rising up the frame;
+- ``segments``: the slice of pixels each named segment covers, and
+  ``corners``, the first pixel of every segment after the first;
+- ``remap``: for segments wired in the opposite direction to the one
+  patterns see ("reverse"), the index of the pattern pixel each output pixel
+  shows. The output stage applies it as a single gather of the packed
+  frame. It is None when nothing is reversed.
+
+Layouts are written as JSON, as a list of segments in wiring order:
+
+    [{"name": "left", "count": 121, "from": [0, 0], "to": [0, 1]},
+     {"name": "top", "count": 54, "from": [0, 1], "to": [1, 1]},
+     {"name": "right", "count": 125, "from": [1, 1], "to": [1, 0], "reverse": true}]
+
+or as {"matrix": [width, height], "serpentine": true} for a grid of rows.
+"from" and "to" are where the segment's first and last pixel sit, in the
+order patterns see them. Units are arbitrary, and y points up.
+'''
+import json
+
+import numpy as np
+
+
+class Layout:
+    '''
+    Parameters:
+    segments: list of dict
+        Segments in wiring order, as in the module docstring
+    '''
+
+    def __init__(self, segments):
+        if not segments:
+            raise ValueError("A layout needs at least one segment")
+        self.description = segments
+        points, gather = [], []
+        self.segments = {}
+        self.corners = []
+        start = 0
+        for index, segment in enumerate(segments):
+            try:
+                count = int(segment["count"])
+                first = np.asarray(segment.get("from", (start, 0)), dtype=np.float64)
+                last = np.asarray(segment.get("to", (start + count - 1, 0)), dtype=np.float64)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid layout segment {index}: {e}") from None
+            if count <= 0 or first.shape != (2,) or last.shape != (2,):
+                raise ValueError(f"Layout segment {index} needs a positive count and 2D from and to points")
+            # Pixels are spaced evenly from the first point to the last
+            steps = np.linspace(0, 1, count)[:, None]
+            points.append(first + (last - first) * steps)
+            indices = np.arange(start, start + count)
+            gather.append(indices[::-1] if segment.get("reverse") else indices)
+            if "name" in segment:
+                self.segments[segment["name"]] = slice(start, start + count)
+            if index:
+                self.corners.append(start)
+            start += count
+        points = np.concatenate(points)
+        low, extent = points.min(axis=0), np.ptp(points, axis=0)
+        normalized = (points - low) / np.where(extent > 0, extent, 1)
+        self.x = normalized[:, 0].copy()
+        self.y = normalized[:, 1].copy()
+        for array in (self.x, self.y):
+            array.flags.writeable = False
+        gather = np.concatenate(gather)
+        self.remap = None if (gather == np.arange(start)).all() else gather
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def line(cls, num_pixels):
+        '''A straight strip along x, as patterns see it without a layout.'''
+        return cls([{"count": num_pixels}])
+
+    @classmethod
+    def matrix(cls, width, height, serpentine=True):
+        '''A grid wired row by row from the bottom left, every other row backwards if serpentine.'''
+        return cls([{"name": f"row{row}", "count": width, "from": [0, row], "to": [width - 1, row],
+                     "reverse": serpentine and row % 2 == 1} for row in range(height)])
+
+    @classmethod
+    def from_json(cls, data):
+        '''Build a layout from its JSON form. Raises ValueError if it is invalid.'''
+        if isinstance(data, dict) and "matrix" in data:
+            try:
+                width, height = (int(v) for v in data["matrix"])
+            except (TypeError, ValueError):
+                raise ValueError("matrix must be [width, height]") from None
+            return cls.matrix(width, height, bool(data.get("serpentine", True)))
+        if not isinstance(data, list):
+            raise ValueError("A layout is a list of segments or a matrix")
+        return cls(data)
+
+    def key(self):
+        '''A string that identifies the layout, for cache keys.'''
+        return json.dumps(self.description, sort_keys=True)
@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 
-import time
-from rpi_ws281x import PixelStrip, Color
+import os
 import argparse
-from random import randint
+import functools
+import json
+import sys
+import time
+if os.environ.get("PILED_STRIP") == "mock":
+    from mock_strip import PixelStrip, PWMController  # Simulated strip for dev boxes and benchmarks
+else:
+    from rpi_ws281x import PixelStrip
+    from outputs import PWMController
 import numpy as np
-import threading
-from tools import light_segment, randomRGB, explosion, wheel, threshold_brightness
-
-import random
+from framebuffer import FrameBuffer
+from layout import Layout
+from outputs import Outputs, StripOutput, DDPOutput, E131Output, ArtNetOutput
+from render import Renderer
+from tools import channel_table
+from transitions import Transition
+import patterns
+import registry
+import sequencer
 
 # LED strip configuration:
 LED_COUNT = 300        # Number of LED pixels.
@@ -19,413 +31,301 @@ LED_DMA = 10          # DMA channel to use for generating signal (try 10)
 LED_BRIGHTNESS = 255  # Set to 0 for darkest and 255 for brightest
 LED_INVERT = False    # True to invert the signal (when using NPN transistor level shift)
 LED_CHANNEL = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
-# LEFT_CORNER = 
-# RIGHT_CORNER =
+LED_FPS = 60          # Target frame rate of the render loop
+LED_GAMMA = 1.0       # Output gamma; 1.0 is linear, 2.2-2.8 gives perceptually even fades
+LED_MAX_MILLIAMPS = 6000  # Power supply budget; frames estimated above it are dimmed. None disables the limiter
+LED_DITHER = True     # Temporal dithering: dim and gamma-corrected levels keep their fractions instead of banding
+LED_TRANSITION = "fade"  # How patterns switch by default: "fade", "wipe" or "dissolve"
+LED_TRANSITION_S = 0.5   # Length of the default transition; 0 switches with a hard cut
+LED_KEEPALIVE_S = 1.0  # An unchanged frame is resent this often, as network receivers drop a silent source
+
+# Output channels, in the order they make up the logical strip. Each one is a
+# strip with its own pixel count; keys left out take the defaults above. Strips
+# on the two PWM channels (PWM_CHANNELS) are driven together, so they share one
+# DMA channel and frequency; every other strip needs a DMA channel of its
+# own. A channel with a "type" from
+# NETWORK_OUTPUTS is sent over UDP to a remote controller instead, given its
+# "host" and "count" (and optionally "port" and, for e131/artnet, the first
+# "universe"). PILED_CHANNELS overrides this with the same list as JSON.
+LED_CHANNELS = [
+    {"count": LED_COUNT, "pin": LED_PIN, "dma": LED_DMA, "channel": LED_CHANNEL},
+    # {"count": 150, "pin": 13, "dma": 11, "channel": 1},  # Second PWM channel
+    # {"count": 150, "pin": 10, "dma": 5, "channel": 0},  # SPI on /dev/spidev0.0
+    # {"type": "ddp", "host": "192.168.1.50", "count": 600},  # WLED or another DDP controller
+]
+CHANNEL_KEYS = ("count", "pin", "freq_hz", "dma", "invert", "channel")
+PWM_CHANNELS = {12: 0, 18: 0, 40: 0, 52: 0, 13: 1, 19: 1, 41: 1, 45: 1, 53: 1}  # PWM channel of each GPIO
+NETWORK_OUTPUTS = {"ddp": DDPOutput, "e131": E131Output, "artnet": ArtNetOutput}
+
+# Where the pixels are, as segments in wiring order (see layout.py): up the
+# left of the door, across the top and down the right. The corners are where
+# one segment meets the next. PILED_LAYOUT overrides this with the same JSON;
+# a layout that does not cover every pixel is ignored for a straight line.
+LED_LAYOUT = [
+    {"name": "left", "count": 121, "from": [0, 0], "to": [0, 1]},
+    {"name": "top", "count": 54, "from": [0, 1], "to": [1, 1]},  # Above the door
+    {"name": "right", "count": 125, "from": [1, 1], "to": [1, 0]},
+]
+
+
+def load_channels():
+    """The channel config: PILED_CHANNELS if set, LED_CHANNELS otherwise."""
+    config = os.environ.get("PILED_CHANNELS")
+    return json.loads(config) if config else LED_CHANNELS
+
+
+def load_layout(num_pixels):
+    """The layout: PILED_LAYOUT if set, LED_LAYOUT otherwise, or a straight line if it does not fit."""
+    config = os.environ.get("PILED_LAYOUT")
+    layout = Layout.from_json(json.loads(config) if config else LED_LAYOUT)
+    if len(layout) != num_pixels:
+        print(f"The layout has {len(layout)} pixels but the outputs have {num_pixels}; using a straight line",
+              file=sys.stderr)
+        return Layout.line(num_pixels)
+    return layout
+
+
+def open_pwm(channels):
+    """Open the PWM strips as one PWMController, begun. Raises ValueError if they cannot share one."""
+    numbers = [PWM_CHANNELS[config.get("pin", LED_PIN)] for config in channels]
+    if any(config.get("channel", number) != number for number, config in zip(numbers, channels)):
+        raise ValueError(f"GPIOs {', '.join(str(pin) for pin, number in PWM_CHANNELS.items() if number)} "
+                         "are on PWM channel 1, the others on channel 0")
+    if len(set(numbers)) != len(numbers):
+        raise ValueError("Each PWM strip needs a PWM channel of its own")
+    for key, default in (("dma", LED_DMA), ("freq_hz", LED_FREQ_HZ)):
+        if len({config.get(key, default) for config in channels}) > 1:
+            raise ValueError(f"The PWM strips are driven together, so they need the same {key}")
+    controller = PWMController([{"channel": number, "count": config.get("count", LED_COUNT),
+                                 "pin": config.get("pin", LED_PIN), "invert": config.get("invert", LED_INVERT)}
+                                for number, config in zip(numbers, channels)],
+                               channels[0].get("freq_hz", LED_FREQ_HZ), channels[0].get("dma", LED_DMA),
+                               LED_BRIGHTNESS)
+    controller.begin()
+    return controller
+
+
+def open_outputs(channels):
+    """Open an output for each channel config. Raises ValueError for an unknown type or setting."""
+    channels = [dict(config) for config in channels]
+    for config in channels:
+        if config.get("type", "ws281x") == "ws281x":
+            unknown = config.keys() - set(CHANNEL_KEYS) - {"type"}
+            if unknown:
+                raise ValueError(f"Unknown channel setting {', '.join(sorted(unknown))}")
+    pwm = [config for config in channels
+           if config.get("type", "ws281x") == "ws281x" and config.get("pin", LED_PIN) in PWM_CHANNELS]
+    controller = open_pwm(pwm) if pwm else None
+    pwm_strips = iter(controller.strips if controller else ())
+    outputs = []
+    start = 0
+    for config in channels:
+        kind = config.pop("type", "ws281x")
+        if kind in NETWORK_OUTPUTS:
+            try:
+                outputs.append(NETWORK_OUTPUTS[kind](config.pop("host", None), start, config.pop("count"),
+                                                     **config))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Bad {kind} channel setting: {e}") from None
+        elif kind == "ws281x" and config.get("pin", LED_PIN) in PWM_CHANNELS:
+            outputs.append(StripOutput(next(pwm_strips), start, controller))
+        elif kind == "ws281x":
+            strip = PixelStrip(config.get("count", LED_COUNT), config.get("pin", LED_PIN),
+                               config.get("freq_hz", LED_FREQ_HZ), config.get("dma", LED_DMA),
+                               config.get("invert", LED_INVERT), LED_BRIGHTNESS,
+                               config.get("channel", LED_CHANNEL))
+            strip.begin()
+            outputs.append(StripOutput(strip, start))
+        else:
+            raise ValueError(f"Unknown channel type {kind!r}")
+        start += len(outputs[-1])
+    return Outputs(outputs)
 
 
 class LED:
 
-    def __init__(self, brightness=1.0):
+    def __init__(self, brightness=1.0, channels=None):
 
-        self.strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
-        self.strip.begin()
+        self.outputs = open_outputs(load_channels() if channels is None else channels)
+        self.strips = [output.strip for output in self.outputs if isinstance(output, StripOutput)]
+        self.fb = FrameBuffer(self.outputs.num_pixels, max_milliamps=LED_MAX_MILLIAMPS,
+                              dither=LED_DITHER, layout=load_layout(self.outputs.num_pixels))
+        self._physical = np.zeros(len(self.fb), dtype=np.uint32)  # The packed frame in wiring order
+        self.renderer = Renderer(self, fps=LED_FPS)
 
-        # self.brightness = brightness
-        # if self.brightness < 0:
-        #     self.brightness = 0
-        # elif self.brightness > 1:
-        #     self.brightness = 1
+        self.set_brightness(brightness)
         
+        self.transition = Transition(LED_TRANSITION, LED_TRANSITION_S)
         self.current_pattern = "clear"
         self.rgb = [0, 0, 0]
         self.delay_ms = 20
-
-    def solidColor(self, rgb):
-        """Fill the entire strip with a single color."""
-        self.current_pattern = "solidColor"
-        self.rgb = threshold_brightness(self.strip, rgb)
-        # self.rgb = rgb
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, Color(*self.rgb))
-        self.strip.show()
-
-
-    def colorWipe(self, rgb, delay_ms=50):
-        """Wipe color across display a pixel at a time."""
-        self.current_pattern = "colorWipe"
-        self.rgb = threshold_brightness(self.strip, rgb)
-        # self.rgb = rgb
-        self.delay_ms = delay_ms
-        while True:
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, Color(*self.rgb))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, Color(0, 0, 0))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-
-    def melt(self, rgb, delay_ms=60, off_delay_ms=30, drip_delay_ms=20):
-        """Melt from the lit midsection to the sides"""
-        self.current_pattern = "melt"
-        self.rgb = self.randomRGB()
-        self.delay_ms = delay_ms # Speed of the downward extension
-        self.off_delay_ms = off_delay_ms # Speed of return
-        self.drip_delay_ms = drip_delay_ms # Speed of the drop
-        cum_height_right = 0 # Height of the accumulation 
-        cum_height_left = 0
-        loop_counter = 0
-        direction = 'left'  
-        while True:  
-            start, end = (LED_COUNT / 2) - 59 // 2, (LED_COUNT / 2) + 50 // 2 # Middle segment above the door
-            self.lightSegment(int(start), int(end), self.rgb, exclusive=False)
-            time.sleep(delay_ms / 1000.0)
-            for l in range(80, 1, -1):  # So that the length of the extension is shorter on each drop
-                if direction == 'right':
-                    for i in range(int(end), int(end + l)): # Extending to the right
-                        self.strip.setPixelColor(i, Color(*self.rgb))
-                        self.strip.show()
-                        time.sleep(self.delay_ms / 1000.0)
-                    for i in range(int(end + l), int(end + l + 2)): # Drop forming
-                        self.strip.setPixelColor(i, Color(*self.rgb))
-                        self.strip.show()
-                        time.sleep(self.delay_ms / 1000.0)
-                    def drip_right(): # Drop falling
-                        for i in range(int(end + l + 2), LED_COUNT - cum_height_right - 2):
-                            self.strip.setPixelColor(i - 2, Color(0, 0, 0))
-                            self.strip.setPixelColor(i, Color(*self.rgb))
-                            self.strip.show()
-                            time.sleep(self.drip_delay_ms / 1000.0)
-                        self.lightSegment(int(LED_COUNT - cum_height_right - 2), int(LED_COUNT - cum_height_right), self.rgb, exclusive=False) # Drops accumulating at the bottom
-                    cum_height_right += 2 # Increasing height of the accumulation on the right
-                    thread1 = threading.Thread(target=drip_right) 
-                    thread1.start()
-                else:  # If side == left
-                    # Same as the code for the right side above, but mirrored and defined with regard to "start" rather than "end"
-                    for i in range(int(start), int(start - l), -1):
-                        self.strip.setPixelColor(i, Color(*self.rgb))
-                        self.strip.show()
-                        time.sleep(self.delay_ms / 1000.0)
-                    for i in range(int(start - l - 2), int(start - l), -1):
-                        self.strip.setPixelColor(i, Color(*self.rgb))
-                        self.strip.show()
-                        time.sleep(self.delay_ms / 1000.0)
-                    def drip_left():
-                        for i in range(int(start - l - 2), int(cum_height_left + 2), -1):
-                            self.strip.setPixelColor(i + 2, Color(0, 0, 0))
-                            self.strip.setPixelColor(i, Color(*self.rgb))
-                            self.strip.show()
-                            time.sleep(self.drip_delay_ms / 1000.0)
-                        self.lightSegment(int(cum_height_left), int(2 + cum_height_left), self.rgb, exclusive=False)
-                    cum_height_left += 2
-                    thread1 = threading.Thread(target=drip_left)
-                    thread1.start()
-                def retract(): # Return after the drop has separated
-                    if direction == 'right':
-                        for i in range(int(end + l), int(end), -1):
-                            self.strip.setPixelColor(i, Color(0, 0, 0))
-                            self.strip.show()
-                            time.sleep(self.off_delay_ms / 1000.0)
-                    else:  # If direction == "left"
-                        for i in range(int(start - l), int(start), 1):
-                            self.strip.setPixelColor(i, Color(0, 0, 0))
-                            self.strip.show()
-                            time.sleep(self.off_delay_ms / 1000.0)
-                thread2 = threading.Thread(target=retract)
-                thread2.start()
-                thread1.join()
-                thread2.join() # Threading makes it so that the retraction and the drop can happen simultaneously
-                direction = random.choice(['left', 'right']) # Randomly picking direction for the next loop
-            for i in range(LED_COUNT):
-                self.strip.setPixelColor(i, Color(0, 0, 0)) # Extinguishing all lights after all drops have been dropped
-                cum_height_right = 0 # Resetting accumulations so that they start at the bottom again
-                cum_height_left = 0
-                self.rgb = self.randomRGB() # Changing color
-            loop_counter += 1
-
-
-    def rainbowWipe(self, delay_ms=35):
-        """Wipe rainbow across display a pixel at a time."""
-        self.current_pattern = "rainbowWipe"
-        self.delay_ms = delay_ms
-        while True:
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, wheel((i) & 255))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-            for i in range(self.strip.numPixels(), 0, -1):
-                self.strip.setPixelColor(i, Color(0, 0, 0))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-            for i in range(self.strip.numPixels(), 0, -1):
-                self.strip.setPixelColor(i, wheel((i) & 255))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i,  Color(0, 0, 0))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-
-
-    def rainbowWipeAlwaysOn(self, delay_ms=20):
-        """Wipe rainbow across display a pixel at a time."""
-        self.current_pattern = "rainbowWipeAlwaysOn"
-        self.delay_ms = delay_ms
-    
-        while True:
-            offset = randint(0, 255)
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i, wheel((i+offset) & 255))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-            offset = randint(0, 255)
-            for i in range(self.strip.numPixels(), 0, -1):
-                self.strip.setPixelColor(i,  wheel((i+offset) & 255))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-    
-
-    def randomWipe(self, delay_ms=35):
-        """Wipe rainbow across display a pixel at a time."""
-        self.current_pattern = "randomWipe"
-        self.delay_ms = delay_ms
-        while True:
-            for i in range(self.strip.numPixels()):
-                self.strip.setPixelColor(i,  wheel((i+randint(0, 255)) & 255))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-
-
-    def colorShots(self, min=20, length=5, delay_ms_min=10, delay_ms_max=30):
-        self.current_pattern = "colorShots"
-        while True:
-            rand_rgb = randomRGB(self.strip)
-            endpoint = randint(min, self.strip.numPixels())
-            rand_delay_ms = randint(delay_ms_min, delay_ms_max)
-            if randint(0, 1) == 0:
-                # go from left
-                for i in range(endpoint-length):
-                    '''move the segment along the strip'''
-                    light_segment(self.strip, i, i+length, rand_rgb)
-                    time.sleep(rand_delay_ms / 1000.0)
-                for i in range(length-3):
-                    '''fade the segment out'''
-                    light_segment(self.strip, endpoint-length+i, endpoint, rand_rgb)
-                    time.sleep(rand_delay_ms / 1000.0)
-            else:
-                # go from right
-                for i in range(self.strip.numPixels(), endpoint+length, -1):
-                    '''move the segment along the strip'''
-                    light_segment(self.strip, i-length, i, rand_rgb)
-                    time.sleep(rand_delay_ms / 1000.0)
-                for i in range(length-3):
-                    '''fade the segment out'''
-                    light_segment(self.strip, endpoint, endpoint+length-i, rand_rgb)
-                    time.sleep(rand_delay_ms / 1000.0)
-            # rand_rgb = [randint(0, 255) for _ in range(3)]
-            rand_rgb = randomRGB(self.strip, min_diff=100)
-            explosion_size = randint(70, 300)
-            explosion_delay_ms = randint(5, 10)
-            explosion(self.strip, rand_rgb, endpoint, size=explosion_size, fade=.2, delay_ms=explosion_delay_ms)
-            # clear the strip
-            self.clear()
-
-
-    def fireShotLeft(self, min, length, delay_ms_min, delay_ms_max):
-        rand_rgb = randomRGB(self.strip)
-        endpoint = randint(min, self.strip.numPixels())
-        rand_delay_ms = randint(delay_ms_min, delay_ms_max)
-        for i in range(endpoint-length):
-            '''move the segment along the strip'''
-            light_segment(self.strip, i, i+length, rand_rgb, 
-                                exclusive=False, show=False)
-            self.strip.setPixelColor(i-1, Color(0, 0, 0))
-            self.strip.show()
-            time.sleep(rand_delay_ms / 1000.0)
-        light_segment(self.strip, start=endpoint-length-1, end=endpoint, rgb=[0, 0, 0], 
-                          exclusive=False, show=True)
-        rand_rgb = randomRGB(self.strip, min_diff=100)
-        explosion_size = randint(70, 300)
-        explosion_delay_ms = randint(5, 10)
-        explosion(self.strip, rand_rgb, endpoint, size=explosion_size, fade=.2, delay_ms=explosion_delay_ms)
-
-
-    def fireShotRight(self, min, length, delay_ms_min, delay_ms_max):
-        rand_rgb = randomRGB(self.strip)
-        endpoint = randint(min, self.strip.numPixels())
-        rand_delay_ms = randint(delay_ms_min, delay_ms_max)
-        for i in range(self.strip.numPixels(), endpoint+length, -1):
-            '''move the segment along the strip'''
-            light_segment(self.strip, i-length, i, rand_rgb,
-                                exclusive=False, show=False)
-            self.strip.setPixelColor(i+1, Color(0, 0, 0))
-            self.strip.show()
-            time.sleep(rand_delay_ms / 1000.0)
-        light_segment(self.strip, endpoint-1, endpoint+length+1, [0, 0, 0],
-                          exclusive=False, show=True)
-        rand_rgb = randomRGB(self.strip, min_diff=100)
-        explosion_size = randint(150, 300)
-        explosion_delay_ms = randint(3, 7)
-        explosion(self.strip, rand_rgb, endpoint, size=explosion_size, fade=.2, delay_ms=explosion_delay_ms)
-
-
-    def fireShotRandom(self, min, length, delay_ms_min, delay_ms_max):
-        if randint(0, 1) == 0:
-            self.fireShotLeft(min, length, delay_ms_min, delay_ms_max)
+        self.params = {}
+        self.params_version = 0
+        self.latched_ns = 0
+
+    def show(self):
+        """Pack the whole framebuffer, copy each channel's span to its output and latch them all."""
+        self.outputs.write(self._wiring_order(self.fb.pack()))
+        self.outputs.show(everything=True)
+        self.latched_ns = time.monotonic_ns()
+
+    def commit(self):
+        """Repack and copy into the outputs only the span that changed since the last commit.
+
+        Returns False, doing nothing, if the frame is unchanged."""
+        span = self.fb.pack_changes()
+        if span is None:
+            return False
+        if self.fb.layout.remap is None:
+            self.outputs.write(self.fb.packed, *span)
         else:
-            self.fireShotRight(min, length, delay_ms_min, delay_ms_max)
-
-
-    def colorShotsMultiple(self, min=20, length=5, delay_ms_min=5, delay_ms_max=20):
-        self.current_pattern = "colorShotsMultiple"
-
-        while True:
-            thread1 = threading.Thread(target=self.fireShotRandom, 
-                                       kwargs={"min": min, 
-                                               "length": length,
-                                               "delay_ms_min": delay_ms_min,
-                                               "delay_ms_max": delay_ms_max})
-            thread2 = threading.Thread(target=self.fireShotRandom,
-                                       kwargs={"min": min, 
-                                               "length": length,
-                                               "delay_ms_min": delay_ms_min,
-                                               "delay_ms_max": delay_ms_max})
-            thread1.start()
-            time.sleep(1)
-            thread2.start()
-            time.sleep(1)
-            thread1.join()
-            self.clear()
-
-
-    def theaterChase(self, rgb, delay_ms=50):
-        """Movie theater light style chaser animation."""
-        self.current_pattern = "theaterChase"
-        self.rgb = rgb
-        self.delay_ms = delay_ms
-        while True:
-            for q in range(3):
-                for i in range(0, self.strip.numPixels(), 3):
-                    self.strip.setPixelColor(i + q, Color(*self.rgb))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-                for i in range(0, self.strip.numPixels(), 3):
-                    self.strip.setPixelColor(i + q, 0)
-
-    
-    def rainbowCycle(self, delay_ms=20, iterations=5):
-        """Draw rainbow that uniformly distributes itself across all pixels."""
-        self.current_pattern = "rainbowCycle"
-        self.delay_ms = delay_ms
-        while True:
-            for j in range(256 * iterations):
-                for i in range(self.strip.numPixels()):
-                    self.strip.setPixelColor(i, wheel((int(i * 256 / self.strip.numPixels()) + j) & 255))
-                self.strip.show()
-                time.sleep(self.delay_ms / 1000.0)
-    
-
-    def theaterChaseRainbow(self, delay_ms=50):
-        """Rainbow movie theater light style chaser animation."""
-        self.current_pattern = "theaterChaseRainbow"
-        self.delay_ms = delay_ms
-        while True:
-            for j in range(256):
-                for q in range(3):
-                    for i in range(0, self.strip.numPixels(), 3):
-                        self.strip.setPixelColor(i + q, wheel((i + j) % 255))
-                    self.strip.show()
-                    time.sleep(self.delay_ms / 1000.0)
-                    for i in range(0, self.strip.numPixels(), 3):
-                        self.strip.setPixelColor(i + q, 0)
-    
-
-    def rainbow(self, delay_ms=20, iterations=1):
-        """Draw rainbow that fades across all pixels at once."""
-        while True:
-            for j in range(256 * iterations):
-                for i in range(self.strip.numPixels()):
-                    self.strip.setPixelColor(i, wheel((i + j) & 255))
-                self.strip.show()
-                time.sleep(delay_ms / 1000.0)
-
+            self.outputs.write(self._wiring_order(self.fb.packed))  # Reversed segments scatter the span
+        return True
+
+    def _wiring_order(self, packed):
+        """The packed frame reordered for the outputs, with one gather if the layout has reversed segments."""
+        remap = self.fb.layout.remap
+        if remap is None:
+            return packed
+        return np.take(packed, remap, out=self._physical)
+
+    def latch(self, changed=True):
+        """Show the outputs written by commit(). With nothing changed, only resend the frame every LED_KEEPALIVE_S."""
+        now = time.monotonic_ns()
+        if changed:
+            self.outputs.show()
+        elif now - self.latched_ns >= LED_KEEPALIVE_S * 1e9:
+            self.outputs.show(everything=True)
+        else:
+            return
+        self.latched_ns = now
+
+    def start(self, pattern, transition=None, **params):
+        """Switch the render loop to a pattern from patterns.py. Takes effect on the next frame.
+
+        The switch uses transition, a transitions.Transition, or self.transition
+        if None. Returns the CancelToken of the new pattern."""
+        self.current_pattern = pattern.__name__
+        self.params = params
+        self.params_version += 1
+        return self._switch(lambda fb: pattern(fb, self.params), transition)
+
+    def play_timeline(self, timeline, transition=None, compile=True):
+        """Play a sequencer.Timeline, rendering its cached segments first if they are not cached yet.
+
+        Pass compile=False for a timeline already compiled for this strip, so none of that runs on the
+        render thread. Returns the CancelToken."""
+        if compile:
+            timeline.compile(len(self.fb), self.renderer.fps, layout=self.fb.layout)
+        self.current_pattern = sequencer.NAME
+        self.params = {}
+        self.params_version += 1
+        return self._switch(lambda fb: timeline.play(fb, self.params), transition)
+
+    def _switch(self, make, transition):
+        """Hand the renderer make(fb), drawing straight into self.fb or, to blend it in, into a framebuffer of its own."""
+        if transition is None:
+            transition = self.transition
+        if not transition.seconds:
+            return self.renderer.set_pattern(make(self.fb))
+        fb = FrameBuffer(len(self.fb), layout=self.fb.layout)
+        return self.renderer.set_pattern(make(fb), functools.partial(transition.play, self.fb, fb))
+
+    def stop(self):
+        """Stop the running pattern at the next frame boundary, holding the last frame."""
+        self.renderer.stop()
+
+    def play(self, name, *args, transition=None, **params):
+        """Start a pattern from the registry by name, validating its params and filling in defaults.
+
+        Raises ValueError for an unknown pattern or invalid params. Returns the CancelToken."""
+        params = registry.get(name).bind(*args, **params)
+        if "rgb" in params:
+            self.rgb = params["rgb"]
+        if "delay_ms" in params:
+            self.delay_ms = params["delay_ms"]
+        return self.start(registry.PATTERNS[name].function, transition, **params)
+
+    def __getattr__(self, name):
+        # led.rainbow(delay_ms=20), led.solidColor((255, 0, 0)), ... for every registered pattern
+        if name in registry.PATTERNS:
+            return functools.partial(self.play, name)
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
 
     def get_params(self):
         return {"rgb": self.rgb,
                  "delay_ms": self.delay_ms, 
+                 "brightness": self.brightness,
                  "current_pattern": self.current_pattern}
     
 
     def set_params(self, **kwargs):
-        if "rgb" in kwargs:
-            self.rgb = kwargs["rgb"]
-        if "delay_ms" in kwargs:
-            self.delay_ms = kwargs["delay_ms"]
+        """Update the running pattern in place. It picks the new values up on its next frame.
+
+        Params the running pattern does not take are ignored. Raises ValueError,
+        changing nothing, if any value is invalid."""
+        brightness = kwargs.pop("brightness", None)
+        if brightness is not None:
+            brightness = registry.BRIGHTNESS.parse(brightness)
+        running = registry.PATTERNS.get(self.current_pattern)
+        declared = running.params if running is not None else {}  # A timeline takes no live params
+        updates = {key: declared[key].parse(value) for key, value in kwargs.items() if key in declared}
+        if brightness is not None:
+            self.set_brightness(brightness)
+        self.params.update(updates)
+        self.rgb = updates.get("rgb", self.rgb)
+        self.delay_ms = updates.get("delay_ms", self.delay_ms)
+        self.params_version += 1
         # if "current_pattern" in kwargs:
         #     self.current_pattern = kwargs["current_pattern"]
         
 
+    def set_brightness(self, brightness):
+        """Global brightness scale between 0 and 1, applied through the output lookup table."""
+        self.brightness = min(max(brightness, 0), 1)
+        self.fb.set_output_table(channel_table(LED_GAMMA, self.brightness))
+
+
     def clear(self, show=True):
-        self.current_pattern = "clear"
-        for i in range(self.strip.numPixels()):
-            self.strip.setPixelColor(i, Color(0, 0, 0))
+        token = self.start(patterns.clear, Transition(seconds=0))
+        self.fb.clear()
         if show:
-            self.strip.show()
+            self.show()
+        return token
     
 
 if __name__ == "__main__":
-    # create an argparser and add arguments for each of the functions in the LED class
     parser = argparse.ArgumentParser(description="LED strip control")
-    parser.add_argument("function", type=str, help="The function to call")
+    parser.add_argument("function", type=str, nargs="?", choices=registry.PATTERNS,
+                        help="The pattern to run")
     parser.add_argument("--color", type=str, help="The color to use as comma separated RGB values")
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=VALUE",
+                        help="Set any other pattern parameter, e.g. --param delay_ms=20")
     parser.add_argument("--brightness", type=float, help="The brightness scale", default=1.0)
+    parser.add_argument("--list", action="store_true", help="List the patterns and their parameters as JSON")
     args = parser.parse_args()
 
+    if args.list or args.function is None:
+        print(json.dumps(registry.describe(), indent=2))
+        raise SystemExit
+    params = dict(param.split("=", 1) for param in args.param)
+    if args.color:
+        params["rgb"] = args.color
+    try:
+        pattern = registry.get(args.function)
+        pattern.bind(**params)
+    except ValueError as e:
+        parser.error(str(e))
+
     led = LED(args.brightness)
     try:
-        if args.function == "solidColor":
-            color = [127, 127, 127]
-            if args.color:
-                color = [int(c) for c in args.color.split(",")]
-            led.solidColor(color)
-        elif args.function == "rainbow":
-            led.rainbow()
-        elif args.function == "rainbowCycle":
-            led.rainbowCycle()
-        elif args.function == "theaterChase":
-            color = [255, 255, 255]
-            if args.color:
-                color = [int(c) for c in args.color.split(",")]
-            led.theaterChase(color)
-        elif args.function == "colorWipe":
-            color = [127, 127, 127]
-            if args.color:
-                color = [int(c) for c in args.color.split(",")]
-            led.colorWipe(color)
-        elif args.function == "theaterChaseRainbow":
-            led.theaterChaseRainbow()
-        elif args.function == "melt":
-            color = [127, 127, 127]
-            if args.color:
-                color = [int(c) for c in args.color.split(",")]
-            led.melt(color)
-        elif args.function == "colorShots":
-            # color = [127, 127, 127]
-            # if args.color:
-            #     color = [int(c) for c in args.color.split(",")]
-            led.colorShots()
-        elif args.function == "rainbowWipeAlwaysOn":
-            led.rainbowWipeAlwaysOn()
-        elif args.function == "rainbowWipe":
-            led.rainbowWipe()
-        elif args.function == "randomWipe":
-            led.randomWipe()
-        elif args.function == "clear":
-            led.clear()
+        # A hard cut: a fresh process has nothing to blend from, and a static
+        # pattern only renders one frame, which a fade would leave black
+        led.play(args.function, transition=Transition(seconds=0), **params)
+        if pattern.static:
+            led.renderer.run(frames=1)
         else:
-            print("Invalid function")
-            exit(1)
+            led.renderer.run()
     except KeyboardInterrupt:
         led.clear()
-        raise SystemExit
\ No newline at end of file
+        raise SystemExit
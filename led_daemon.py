@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+'''
+Long-lived renderer process.
+
+The daemon owns the single PixelStrip and runs the render loop forever.
+Web workers talk to it with small JSON commands over a Unix datagram
+socket; a command wakes the render loop and is applied between frames, so a
+pattern switch takes effect at once without forking or killing anything.
+
+Run it directly (``python led_daemon.py``) or let app.py start it under a
+supervisor (``--supervise``) that starts it again if it ever dies. Only one
+daemon can hold the lock file, so extra copies exit straight away.
+'''
+import collections
+import fcntl
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import registry
+import sequencer
+from control import CommandQueue
+from profiler import Profiler
+from shared_state import StateWriter
+from transitions import Transition
+
+SOCKET_PATH = os.environ.get("PILED_SOCKET", "/tmp/piled.sock")
+MAX_COMMAND_BYTES = 65536  # Room for a timeline of a few hundred segments
+METRICS_INTERVAL_NS = 250_000_000  # How often the render metrics are copied to shared memory
+RESPAWN_DELAY_S = 1.0  # Pause before the supervisor restarts a daemon that died
+
+
+class LEDDaemon:
+
+    def __init__(self, led, path=SOCKET_PATH):
+        self.led = led
+        self.led.renderer.poll = self.poll
+        self.led.renderer.on_frame = self.publish
+        self.state = StateWriter()
+        if os.path.exists(path):
+            os.unlink(path)  # Stale socket from a previous run; we hold the lock
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.commands = collections.deque()
+        self.compiled = collections.deque()  # (timeline, transition) ready to play
+        self.arrivals = []  # Receive times of the queued commands not yet applied
+        self.metrics_published_ns = 0
+        self.queue = CommandQueue()
+        self.profiler = Profiler(led)
+
+    def receive(self):
+        '''
+        Collect commands as they arrive and wake the render loop, so they are
+        applied straight away rather than at the next tick. Runs on its own
+        thread; the commands themselves are only handled in poll().
+        '''
+        while True:
+            data, _, flags, addr = self.sock.recvmsg(MAX_COMMAND_BYTES)
+            if flags & socket.MSG_TRUNC:
+                # Cut short, so its id is unreadable and no reply can be sent
+                print(f"Dropped a command over {MAX_COMMAND_BYTES} bytes", file=sys.stderr)
+                continue
+            self.commands.append((data, addr, time.monotonic_ns()))
+            if self.queue.due():
+                self.queue.woke()
+                self.led.renderer.wake()
+
+    def poll(self):
+        '''Handle every command that arrived since the last frame, then apply what the queue lets through.'''
+        while self.commands:
+            data, addr, received_ns = self.commands.popleft()
+            command = {}
+            try:
+                command = json.loads(data)
+                reply = self.handle(command)
+                if command["cmd"] in ("pattern", "params"):
+                    self.arrivals.append(received_ns)
+            except (ValueError, TypeError, KeyError) as e:
+                reply = {"status": "error", "message": str(e)}
+            except Exception as e:
+                # A bug, not a bad command, but one command must not take the strip down
+                traceback.print_exc()
+                reply = {"status": "error", "message": f"Internal error: {e}"}
+            if addr and isinstance(command, dict) and "id" in command:
+                reply["id"] = command["id"]
+                try:
+                    self.sock.sendto(json.dumps(reply).encode(), addr)
+                except OSError:
+                    pass  # Client gave up waiting
+
+        while self.compiled:
+            timeline, transition = self.compiled.popleft()
+            self.queue.push_pattern(sequencer.NAME, {"timeline": timeline}, transition)
+
+        pattern, params = self.queue.take()
+        if (pattern is not None or params is not None) and self.queue.pattern is None:
+            # Nothing is left waiting, so the next frame shows every command received so far
+            self.led.renderer.metrics.commands_applied(self.arrivals)
+            self.arrivals.clear()
+        if params is not None:
+            self.led.set_params(**params)
+        if pattern is not None:
+            name, params, transition = pattern
+            if name == sequencer.NAME:
+                self.led.play_timeline(params["timeline"], transition, compile=False)  # Compiled by compile()
+            else:
+                self.led.play(name, transition=transition, **params)
+
+    def handle(self, command):
+        '''Validate a command and queue it. Replies "ok" once it is queued, not applied.'''
+        cmd = command["cmd"]
+        if cmd == "pattern":
+            name = command["name"]
+            self.queue.push_pattern(name, registry.get(name).bind(**command.get("params", {})),
+                                    self.transition(command))
+            return {"status": "ok"}
+        elif cmd == "params":
+            self.queue.push_params(registry.parse_live(command["params"]))
+            return {"status": "ok"}
+        elif cmd == "timeline":
+            timeline = sequencer.Timeline.from_json(command)
+            transition = self.transition(command)
+            threading.Thread(target=self.compile, args=(timeline, transition), daemon=True).start()
+            return {"status": "ok"}
+        elif cmd == "profile":
+            if command.get("action", "start") == "stop":
+                self.profiler.stop()
+            else:
+                self.profiler.start(command.get("seconds", 10), command.get("allocations", False))
+            return {"status": "ok", "path": self.profiler.path}
+        elif cmd == "state":
+            return {"status": "ok",
+                    "current_pattern": self.led.current_pattern,
+                    "params": self.led.params,
+                    "commands": self.queue.counts(),
+                    "transition": self.led.transition.describe(),
+                    "profiling": self.profiler.running}
+        raise ValueError(f"Unknown command {cmd!r}")
+
+    @staticmethod
+    def transition(command):
+        '''The command's "transition", if it has one, or None for the default.'''
+        spec = command.get("transition")
+        return None if spec is None else Transition.parse(spec)
+
+    def compile(self, timeline, transition=None):
+        '''Fill the frame cache for a timeline off the render thread, then queue it to play.'''
+        try:
+            timeline.compile(len(self.led.fb), self.led.renderer.fps, layout=self.led.fb.layout)
+        except Exception:
+            # The command was acknowledged long ago, so the log is the only place to report this
+            print("Timeline compile failed, not playing it", file=sys.stderr)
+            traceback.print_exc()
+            return
+        self.compiled.append((timeline, transition))
+        self.led.renderer.wake()
+
+    def publish(self):
+        '''Write the live state and the frame just shown to shared memory after each frame.'''
+        renderer = self.led.renderer
+        self.state.publish(self.led.current_pattern, self.led.params, self.led.params_version,
+                           self.led.brightness, renderer.frames, renderer.dropped,
+                           renderer.last_frame_ns, renderer.measured_fps, self.queue.counts())
+        if renderer.changed:
+            self.state.publish_frame(renderer.frames, self.led.fb.packed)
+        if renderer.last_frame_ns - self.metrics_published_ns >= METRICS_INTERVAL_NS:
+            self.state.publish_metrics(renderer.metrics)
+            self.metrics_published_ns = renderer.last_frame_ns
+
+    def serve(self):
+        self.led.clear()
+        threading.Thread(target=self.receive, daemon=True).start()
+        try:
+            self.led.renderer.run()
+        finally:
+            self.state.close()
+
+
+class LEDClient:
+    '''
+    Web-tier handle on the daemon. Safe to share between request threads.
+
+    send() is a fire-and-forget datagram; request() tags the command with an
+    id, which makes the daemon reply, and waits for the matching answer.
+    '''
+
+    def __init__(self, path=SOCKET_PATH, timeout=1.0):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind("")  # Autobind an abstract address so the daemon can reply
+        self.sock.settimeout(timeout)
+        self.lock = threading.Lock()
+        self.request_id = 0
+
+    def send(self, cmd, **fields):
+        '''Send a command. Raises ValueError if it is too long for the daemon to receive whole.'''
+        fields["cmd"] = cmd
+        data = json.dumps(fields).encode()
+        if len(data) > MAX_COMMAND_BYTES:
+            raise ValueError(f"Command is {len(data)} bytes, over the {MAX_COMMAND_BYTES} byte limit")
+        self.sock.sendto(data, self.path)
+
+    def request(self, cmd, **fields):
+        with self.lock:
+            self.request_id += 1
+            self.send(cmd, id=self.request_id, **fields)
+            while True:
+                reply = json.loads(self.sock.recv(MAX_COMMAND_BYTES))
+                if reply.pop("id", None) == self.request_id:
+                    return reply
+                # Otherwise it answers an earlier request that timed out
+
+    def start_pattern(self, name, transition=None, **params):
+        '''Switch pattern, with a {"kind", "seconds"} transition or the daemon's default.'''
+        fields = {} if transition is None else {"transition": transition}
+        self.send("pattern", name=name, params=params, **fields)
+
+    def set_params(self, **params):
+        self.send("params", params=params)
+
+    def play_timeline(self, segments, loop=False, transition=None):
+        fields = {} if transition is None else {"transition": transition}
+        self.send("timeline", segments=segments, loop=loop, **fields)
+
+
+def spawn():
+    '''Start a detached, supervised daemon. It exits immediately if one is already running.'''
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "--supervise"], start_new_session=True)
+
+
+def supervise():
+    '''Run the daemon, starting it again whenever it dies with an error. Returns once it exits cleanly.'''
+    child = None
+    stopping = False
+
+    def terminate(signum, frame):
+        # Only signal here: waiting would deadlock with the wait the loop is in
+        nonlocal stopping
+        stopping = True
+        if child is not None:
+            child.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    while not stopping:
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+        status = child.wait()
+        if status == 0 or stopping:
+            return  # Stopped on purpose, or another daemon already owns the strip
+        print(f"LED daemon exited with status {status}, restarting", file=sys.stderr)
+        time.sleep(RESPAWN_DELAY_S)
+
+
+def main():
+    if "--supervise" in sys.argv[1:]:
+        supervise()
+        return
+
+    lock = open(SOCKET_PATH + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return  # Another daemon owns the strip
+
+    from led import LED
+    daemon = LEDDaemon(LED())
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Unwind so the state block is unlinked
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        daemon.led.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+'''
+Simulated PixelStrip for running without rpi_ws281x or real hardware.
+
+Select it by setting PILED_STRIP=mock before importing led.py. It keeps the
+same begin/setPixelColor/getPixelColor/numPixels/setBrightness/show API as
+rpi_ws281x.PixelStrip and stores colors in a uint32 numpy array, which
+framebuffer.write_pixels fills in one copy. PWMController stands in for
+outputs.PWMController the same way.
+'''
+import time
+
+import numpy as np
+
+
+def Color(red, green, blue, white=0):
+    """Convert the provided red, green, blue color to a 24-bit color value."""
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+class PixelStrip:
+
+    def __init__(self, num, pin, freq_hz=800000, dma=10, invert=False,
+                 brightness=255, channel=0, strip_type=None, gamma=None, wire_time=False):
+        '''
+        Parameters:
+        num: int
+            Number of pixels
+        wire_time: bool
+            If True, show() sleeps for as long as sending the frame to real
+            WS2812 pixels would take (30 us per pixel plus the 50 us latch).
+        '''
+        self.leds = np.zeros(num, dtype=np.uint32)
+        self.freq_hz = freq_hz
+        self.brightness = brightness
+        self.wire_time = wire_time
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self.leds)
+
+    def setPixelColor(self, n, color):
+        self.leds[n] = color
+
+    def setPixelColorRGB(self, n, red, green, blue, white=0):
+        self.setPixelColor(n, Color(red, green, blue, white))
+
+    def getPixelColor(self, n):
+        return int(self.leds[n])
+
+    def getBrightness(self):
+        return self.brightness
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def show(self):
+        self.shows += 1
+        if self.wire_time:
+            time.sleep(len(self.leds) * 24 / self.freq_hz + 50e-6)
+
+
+class PWMController:
+    '''Both PWM channels as one device, like outputs.PWMController. show() sends them at once.'''
+
+    def __init__(self, channels, freq_hz, dma, brightness=255):
+        self.strips = [PixelStrip(config["count"], config["pin"], freq_hz, dma, config["invert"], brightness,
+                                  config["channel"]) for config in channels]
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def show(self):
+        self.shows += 1
+        # The channels are interleaved on one DMA stream, so the longer one sets the wire time
+        wired = [strip for strip in self.strips if strip.wire_time]
+        if wired:
+            time.sleep(max(len(strip.leds) for strip in wired) * 24 / wired[0].freq_hz + 50e-6)
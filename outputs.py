@@ -0,0 +1,345 @@
+'''
+Output channels that together make up one logical strip.
+
+Patterns draw into a single FrameBuffer covering every pixel. Each channel
+takes its own span of that frame, in config order, so a pattern that runs
+off the end of the first strip carries on along the second. Every frame is
+packed once, each channel copies its span into its own strip buffer, and
+the channels are then shown one after another. A ws281x show() only starts
+the DMA transfer and returns, so the strips still go out on the wire at the
+same time. Both PWM channels are fed by one PWM block and one DMA stream,
+so strips on them are driven by a single PWMController and shown together
+with one render. When only part of the frame changed, only that part is
+copied and only the channels it touches are shown.
+'''
+import atexit
+import socket
+import struct
+import uuid
+
+import numpy as np
+
+from framebuffer import write_pixels
+
+try:
+    import _rpi_ws281x as ws
+except ImportError:
+    ws = None
+
+
+class StripOutput:
+    '''
+    One strip fed from a span of the logical frame.
+
+    Parameters:
+    strip: PixelStrip instance
+        Already begun
+    start: int
+        Index of the strip's first pixel in the logical frame
+    device: PWMController instance
+        What show() latches, if not the strip itself
+    '''
+
+    def __init__(self, strip, start, device=None):
+        self.strip = strip
+        self.device = strip if device is None else device
+        self.start = start
+        self.stop = start + strip.numPixels()
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def write(self, packed, lo, hi):
+        '''Copy pixels lo:hi (logical indices, within this channel) into the strip. Does not call show().'''
+        write_pixels(self.strip, packed[lo:hi], lo - self.start)
+
+    def show(self):
+        self.device.show()
+
+
+class PWMController:
+    '''
+    Strips on the Pi's two PWM channels, driven as one ws2811_t.
+
+    The channels share the PWM FIFO, and the DMA stream feeding it carries
+    both channels' words interleaved, so they cannot be initialised or
+    rendered separately. show() renders both channels at once.
+
+    Parameters:
+    channels: list of dict
+        One per strip, with its "channel" (0 or 1), "count", "pin" and "invert"
+    freq_hz: int
+        LED signal frequency, shared by both channels
+    dma: int
+        DMA channel, shared by both channels
+    brightness: int
+        0-255
+    '''
+
+    def __init__(self, channels, freq_hz, dma, brightness=255):
+        if ws is None:
+            raise ValueError("PWM strips need rpi_ws281x")
+        self._leds = ws.new_ws2811_t()
+        for index in range(2):
+            channel = ws.ws2811_channel_get(self._leds, index)
+            ws.ws2811_channel_t_count_set(channel, 0)
+            ws.ws2811_channel_t_gpionum_set(channel, 0)
+            ws.ws2811_channel_t_invert_set(channel, 0)
+            ws.ws2811_channel_t_brightness_set(channel, 0)
+        self.strips = []
+        for config in channels:
+            channel = ws.ws2811_channel_get(self._leds, config["channel"])
+            ws.ws2811_channel_t_gamma_set(channel, list(range(256)))
+            ws.ws2811_channel_t_count_set(channel, config["count"])
+            ws.ws2811_channel_t_gpionum_set(channel, config["pin"])
+            ws.ws2811_channel_t_invert_set(channel, int(bool(config["invert"])))
+            ws.ws2811_channel_t_brightness_set(channel, brightness)
+            ws.ws2811_channel_t_strip_type_set(channel, ws.WS2811_STRIP_GRB)
+            self.strips.append(_PWMChannel(channel))
+        ws.ws2811_t_freq_set(self._leds, freq_hz)
+        ws.ws2811_t_dmanum_set(self._leds, dma)
+        atexit.register(self.close)
+
+    def begin(self):
+        self._check(ws.ws2811_init(self._leds), "ws2811_init")
+
+    def show(self):
+        self._check(ws.ws2811_render(self._leds), "ws2811_render")
+
+    def close(self):
+        if self._leds is not None:
+            ws.ws2811_fini(self._leds)
+            ws.delete_ws2811_t(self._leds)
+            self._leds = None
+
+    @staticmethod
+    def _check(resp, call):
+        if resp != 0:
+            raise RuntimeError(f"{call} failed with code {resp} ({ws.ws2811_get_return_t_str(resp)})")
+
+
+class _PWMChannel:
+    '''One channel of a PWMController, with the parts of the PixelStrip API that write_pixels and LED use.'''
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def numPixels(self):
+        return ws.ws2811_channel_t_count_get(self._channel)
+
+    def setPixelColor(self, n, color):
+        ws.ws2811_led_set(self._channel, n, color)
+
+    def getPixelColor(self, n):
+        return ws.ws2811_led_get(self._channel, n)
+
+    def getBrightness(self):
+        return ws.ws2811_channel_t_brightness_get(self._channel)
+
+    def setBrightness(self, brightness):
+        ws.ws2811_channel_t_brightness_set(self._channel, brightness)
+
+
+class Outputs:
+    '''
+    Every output channel, laid end to end in list order.
+
+    show() latches the channels written since the last show() in turn, and
+    channels that share a device, like the two PWM channels, with one show()
+    of it.
+    '''
+
+    def __init__(self, channels):
+        if not channels:
+            raise ValueError("At least one output channel is needed")
+        self.channels = channels
+        self.num_pixels = sum(len(channel) for channel in channels)
+        self._written = set()
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def write(self, packed, lo=0, hi=None):
+        '''Copy pixels lo:hi of a packed frame into the channels they fall on.'''
+        if hi is None:
+            hi = self.num_pixels
+        for index, channel in enumerate(self.channels):
+            if lo < channel.stop and channel.start < hi:
+                channel.write(packed, max(lo, channel.start), min(hi, channel.stop))
+                self._written.add(index)
+
+    def show(self, everything=False):
+        '''Latch the channels written since the last show(), or every channel.'''
+        channels = (self.channels if everything
+                    else [channel for index, channel in enumerate(self.channels) if index in self._written])
+        self._written.clear()
+        shown = []
+        for channel in channels:
+            device = getattr(channel, "device", channel)
+            if not any(device is other for other in shown):
+                device.show()
+                shown.append(device)
+
+
+class UDPOutput:
+    '''
+    Base for network outputs that send a span of the logical frame to a
+    remote controller as UDP packets of RGB bytes.
+
+    Packet headers are built once up front; each frame only fills in the
+    payload, which write() unpacks straight into one contiguous RGB array,
+    and the sequence numbers. show() then sends every packet back to back,
+    each as a single sendmsg() of its header and its slice of the payload,
+    so nothing is copied or allocated per packet.
+
+    Subclasses set PORT, PIXELS_PER_PACKET and SEQUENCE_OFFSET (and
+    EVEN_LENGTH if payloads are padded to an even length) and implement _header(index, start, pixels).
+
+    Parameters:
+    host: str
+        Address of the controller
+    start: int
+        Index of the first pixel in the logical frame
+    count: int
+        Number of pixels to send
+    port: int
+        UDP port, if not the protocol's default
+    '''
+
+    PORT = None
+    PIXELS_PER_PACKET = None
+    SEQUENCE_OFFSET = None
+    EVEN_LENGTH = False
+
+    def __init__(self, host, start, count, port=None):
+        self.start = start
+        self.stop = start + count
+        self.port = self.PORT if port is None else port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sequence = 0
+        self.sent = 0
+        self.errors = 0
+        self._rgb = np.zeros((count, 3), dtype=np.uint8)
+        payload = self._rgb.reshape(-1)
+        self._packets = []
+        for index, first in enumerate(range(0, count, self.PIXELS_PER_PACKET)):
+            pixels = min(self.PIXELS_PER_PACKET, count - first)
+            header = memoryview(self._header(index, first, pixels))
+            buffers = (header, payload[first * 3:(first + pixels) * 3])
+            if self.EVEN_LENGTH and pixels % 2:
+                buffers += (b"\0",)
+            self._packets.append((buffers, self._address(index, host)))
+        self._sequence_bytes = [buffers[0][self.SEQUENCE_OFFSET:self.SEQUENCE_OFFSET + 1]
+                                for buffers, _ in self._packets]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _address(self, index, host):
+        if not host:
+            raise ValueError(f"{type(self).__name__} needs a host")
+        return (host, self.port)
+
+    def _next_sequence(self):
+        self.sequence = self.sequence % 255 + 1  # 1..255; 0 means "not sequenced" in every protocol here
+        return self.sequence
+
+    def write(self, packed, lo, hi):
+        '''Unpack pixels lo:hi (logical indices, within this output) into the packet payloads.'''
+        span = packed[lo:hi]
+        rgb = self._rgb[lo - self.start:hi - self.start]
+        np.right_shift(span, 16, out=rgb[:, 0], casting="unsafe")
+        np.right_shift(span, 8, out=rgb[:, 1], casting="unsafe")
+        rgb[:, 2] = span  # Assignment keeps the low byte
+
+    def show(self):
+        '''
+        Send every packet of the frame, however little of it changed. A
+        network error skips the rest of the frame rather than stopping the loop.
+        '''
+        sequence = self._next_sequence()
+        for view in self._sequence_bytes:
+            view[0] = sequence
+        try:
+            for buffers, address in self._packets:
+                self.sock.sendmsg(buffers, (), 0, address)
+        except OSError:
+            self.errors += 1
+            return
+        self.sent += 1
+
+
+class DDPOutput(UDPOutput):
+    '''
+    Distributed Display Protocol, as spoken by WLED, xLights and most ESP
+    pixel controllers. The frame goes out as packets of up to 480 pixels
+    addressed by byte offset, and the last one carries the push flag so the
+    controller latches the whole frame at once.
+    '''
+
+    PORT = 4048
+    PIXELS_PER_PACKET = 480
+    SEQUENCE_OFFSET = 1
+
+    def _header(self, index, first, pixels):
+        last = first + pixels == len(self)
+        flags = 0x40 | (0x01 if last else 0)  # Version 1, push on the last packet
+        return bytearray(struct.pack(">BBBBIH", flags, 0, 0x0B, 1, first * 3, pixels * 3))  # 8-bit RGB, display 1
+
+    def _next_sequence(self):
+        self.sequence = self.sequence % 15 + 1  # DDP sequence numbers are 4 bits
+        return self.sequence
+
+
+class E131Output(UDPOutput):
+    '''
+    E1.31 (streaming ACN): 170 pixels per DMX universe, numbered from
+    `universe`. Without a host each universe is multicast to its
+    239.255.<hi>.<lo> group.
+    '''
+
+    PORT = 5568
+    PIXELS_PER_PACKET = 170
+    SEQUENCE_OFFSET = 111
+    SOURCE_NAME = b"piled"
+
+    def __init__(self, host, start, count, port=None, universe=1):
+        self.universe = universe
+        self.cid = uuid.uuid4().bytes
+        super().__init__(host, start, count, port)
+
+    def _address(self, index, host):
+        if host:
+            return (host, self.port)
+        universe = self.universe + index
+        return (f"239.255.{universe >> 8}.{universe & 255}", self.port)
+
+    def _header(self, index, first, pixels):
+        slots = pixels * 3
+        return bytearray(
+            struct.pack(">HH12sHI16s", 0x0010, 0, b"ASC-E1.17", 0x7000 | (110 + slots), 0x00000004, self.cid)
+            + struct.pack(">HI64sBHBBH", 0x7000 | (88 + slots), 0x00000002, self.SOURCE_NAME, 100, 0, 0, 0,
+                          self.universe + index)
+            + struct.pack(">HBBHHHB", 0x7000 | (11 + slots), 0x02, 0xA1, 0, 1, slots + 1, 0))
+
+
+class ArtNetOutput(UDPOutput):
+    '''Art-Net ArtDmx: 170 pixels per universe, numbered from `universe` as a 15-bit port address.'''
+
+    PORT = 6454
+    PIXELS_PER_PACKET = 170
+    SEQUENCE_OFFSET = 12
+    EVEN_LENGTH = True
+
+    def __init__(self, host, start, count, port=None, universe=0):
+        self.universe = universe
+        super().__init__(host, start, count, port)
+
+    def _header(self, index, first, pixels):
+        universe = self.universe + index
+        slots = pixels * 3
+        # The DMX length must be even, so a partial last universe with an odd
+        # pixel count is sent with one padding slot
+        return bytearray(struct.pack("<8sH", b"Art-Net", 0x5000)
+                         + struct.pack(">HBBBBH", 14, 0, 0, universe & 0xFF, universe >> 8 & 0x7F, slots + slots % 2))
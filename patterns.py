@@ -0,0 +1,357 @@
+'''
+Time-parameterized LED patterns.
+
+Every pattern is a generator function taking the framebuffer and a params
+dict. The render loop primes it, then sends the time of each frame in
+seconds; the pattern draws the frame at that time into the framebuffer and
+yields. Patterns never call show() or sleep themselves.
+
+Params are read every frame rather than copied at the start, so
+LED.set_params can change color and speed while the pattern keeps running.
+'''
+import random
+from random import randint
+
+import numpy as np
+
+import audio
+from compositor import Compositor, Sprite
+from tools import Stepper, hold, MovingSegment, Explosion, randomRGB, wheel_rgb
+
+
+def solidColor(fb, params):
+    """Fill the entire strip with a single color."""
+    t = yield
+    while True:
+        fb.fill(params["rgb"])
+        t = yield
+
+
+def clear(fb, params):
+    t = yield
+    while True:
+        fb.clear()
+        t = yield
+
+
+def colorWipe(fb, params):
+    """Wipe color across display a pixel at a time."""
+    n = len(fb)
+    stepper = Stepper()
+    t = yield
+    while True:
+        rgb = params["rgb"]
+        step = stepper(t, params["delay_ms"]) % (2 * n)
+        if step < n:
+            fb[:step + 1] = rgb
+            fb[step + 1:] = 0
+        else:
+            fb[:step - n + 1] = 0
+            fb[step - n + 1:] = rgb
+        t = yield
+
+
+def rainbowWipe(fb, params):
+    """Wipe rainbow across display a pixel at a time."""
+    n = len(fb)
+    colors = wheel_rgb(np.arange(n))
+    stepper = Stepper()
+    t = yield
+    while True:
+        phase, k = divmod(stepper(t, params["delay_ms"]) % (4 * n), n)
+        if phase == 0:  # fill forwards
+            lit = slice(0, k + 1)
+        elif phase == 1:  # clear backwards
+            lit = slice(0, n - 1 - k)
+        elif phase == 2:  # fill backwards
+            lit = slice(n - 1 - k, n)
+        else:  # clear forwards
+            lit = slice(k + 1, n)
+        fb.clear()
+        fb[lit] = colors[lit]
+        t = yield
+
+
+def _passes(fb, params, new_colors, backwards_every_other):
+    '''Repeatedly wipe freshly generated colors over the previous pass.'''
+    n = len(fb)
+    stepper = Stepper()
+    colors = fb[:].copy()
+    current = -1
+    t = yield
+    while True:
+        p, k = divmod(stepper(t, params["delay_ms"]), n)
+        if p != current:
+            base, colors, current = colors, new_colors(n), p
+        if backwards_every_other and p % 2:
+            lit = slice(n - 1 - k, n)
+            fb[:n - 1 - k] = base[:n - 1 - k]
+        else:
+            lit = slice(0, k + 1)
+            fb[k + 1:] = base[k + 1:]
+        fb[lit] = colors[lit]
+        t = yield
+
+
+def rainbowWipeAlwaysOn(fb, params):
+    """Wipe rainbow across display a pixel at a time."""
+    return _passes(fb, params, lambda n: wheel_rgb(np.arange(n) + randint(0, 255)),
+                   backwards_every_other=True)
+
+
+def randomWipe(fb, params):
+    """Wipe random colors across display a pixel at a time."""
+    return _passes(fb, params, lambda n: wheel_rgb(np.random.randint(0, 256, n)),
+                   backwards_every_other=False)
+
+
+def theaterChase(fb, params):
+    """Movie theater light style chaser animation."""
+    stepper = Stepper()
+    t = yield
+    while True:
+        q = stepper(t, params["delay_ms"]) % 3
+        fb.clear()
+        fb[q::3] = params["rgb"]
+        t = yield
+
+
+def theaterChaseRainbow(fb, params):
+    """Rainbow movie theater light style chaser animation."""
+    n = len(fb)
+    stepper = Stepper()
+    t = yield
+    while True:
+        step = stepper(t, params["delay_ms"])
+        q, j = step % 3, (step // 3) % 256
+        fb.clear()
+        fb[q::3] = wheel_rgb((np.arange(q, n, 3) - q + j) % 255)
+        t = yield
+
+
+def rainbowCycle(fb, params):
+    """Draw rainbow that uniformly distributes itself across all pixels."""
+    n = len(fb)
+    positions = np.arange(n) * 256 // n
+    stepper = Stepper()
+    t = yield
+    while True:
+        fb[:] = wheel_rgb(positions + stepper(t, params["delay_ms"]))
+        t = yield
+
+
+def rainbow(fb, params):
+    """Draw rainbow that fades across all pixels at once."""
+    positions = np.arange(len(fb))
+    stepper = Stepper()
+    t = yield
+    while True:
+        fb[:] = wheel_rgb(positions + stepper(t, params["delay_ms"]))
+        t = yield
+
+
+def gradient(fb, params):
+    """Fade from one color at the bottom of the layout to another at the top."""
+    y = fb.layout.y[:, None]
+    t = yield
+    while True:
+        bottom = np.asarray(params["rgb"], dtype=np.float64)
+        fb[:] = np.rint(bottom + (np.asarray(params["top_rgb"], dtype=np.float64) - bottom) * y)
+        t = yield
+
+
+def rainbowRise(fb, params):
+    """Draw rainbow bands that rise up through the layout."""
+    heights = (fb.layout.y * 255).astype(np.int64)
+    stepper = Stepper()
+    t = yield
+    while True:
+        fb[:] = wheel_rgb(heights - stepper(t, params["delay_ms"]))
+        t = yield
+
+
+def _release(levels, shown, dt, release_ms):
+    '''Follow audio levels up at once and back down over about release_ms, in place in shown.'''
+    shown *= np.exp(-dt * 1000 / release_ms)
+    np.maximum(shown, levels, out=shown)
+
+
+def audioSpectrum(fb, params):
+    """Spread the audio bands along the strip, bass first, each in its own rainbow color and lit by its level."""
+    n = len(fb)
+    band = np.arange(n) * audio.BANDS // n  # Band shown on each pixel
+    colors = wheel_rgb(np.arange(audio.BANDS) * 256 // audio.BANDS).astype(np.float32)
+    levels = np.zeros(audio.BANDS, dtype=np.float32)
+    shown = np.zeros(audio.BANDS, dtype=np.float32)
+    band_rgb = np.zeros((audio.BANDS, 3), dtype=np.float32)
+    with audio.listen() as analyzer:
+        t = last = yield
+        while True:
+            analyzer.latest(levels)
+            levels *= params["gain"]
+            np.minimum(levels, 1, out=levels)
+            _release(levels, shown, t - last, params["release_ms"])
+            np.multiply(colors, shown[:, None], out=band_rgb)
+            fb[:] = band_rgb[band]
+            last = t
+            t = yield
+
+
+def audioPulse(fb, params):
+    """Pulse the whole strip with the bass, in a rainbow color that follows the pitch of the music."""
+    levels = np.zeros(audio.BANDS, dtype=np.float32)
+    shown = np.zeros(audio.BANDS, dtype=np.float32)
+    positions = np.arange(audio.BANDS, dtype=np.float32) * 256 / audio.BANDS
+    bass = slice(0, audio.BANDS // 4)
+    with audio.listen() as analyzer:
+        t = last = yield
+        while True:
+            analyzer.latest(levels)
+            levels *= params["gain"]
+            np.minimum(levels, 1, out=levels)
+            _release(levels, shown, t - last, params["release_ms"])
+            total = float(shown.sum())
+            centroid = int(positions @ shown / total) if total else 0  # Band weighted by level
+            fb.fill(wheel_rgb(centroid) * float(shown[bass].max()))
+            last = t
+            t = yield
+
+
+class Shot(Sprite):
+    '''
+    Segment fired from one end of the strip that explodes at a random point.
+    Random choices come from rng, so a seeded random.Random replays the same shot.
+    '''
+
+    def __init__(self, n, min, length, delay_ms_min, delay_ms_max, direction=None, rng=random):
+        if direction is None:
+            direction = rng.choice(["left", "right"])
+        self.n = n
+        self.rng = rng
+        # Keep the endpoint on the strip even if min or length are too big for it
+        last = max(n - length, 0)
+        self.endpoint = rng.randint(min if min < last else last, last)
+        rand_delay_ms = rng.randint(delay_ms_min, max(delay_ms_min, delay_ms_max))
+        if direction == "left":
+            self.sprite = MovingSegment(randomRGB(rng=rng), 0, self.endpoint - length, length, 1, rand_delay_ms)
+        else:
+            self.sprite = MovingSegment(randomRGB(rng=rng), n - length, self.endpoint, length, 1, rand_delay_ms)
+        self.exploded = False
+
+    def update(self, t):
+        if self.sprite.update(t):
+            return True
+        if self.exploded:
+            return False
+        # The segment has arrived: it disappears and explodes on the same frame
+        self.exploded = True
+        rng = self.rng
+        self.sprite = Explosion(randomRGB(min_diff=100, rng=rng), self.endpoint, self.n,
+                                size=rng.randint(70, 300), fade=.2, delay_ms=rng.randint(5, 10))
+        return self.sprite.update(t)
+
+    def draw(self, paint):
+        self.sprite.draw(paint)
+
+
+def _shot(fb, params):
+    return Shot(len(fb), params["min"], params["length"], params["delay_ms_min"], params["delay_ms_max"])
+
+
+def colorShots(fb, params):
+    """Fire one shot at a time, each ending in an explosion."""
+    shots = Compositor(fb)
+    t = yield
+    while True:
+        shots.clear()
+        shots.add(_shot(fb, params))
+        t = yield from shots.play(t)
+
+
+def colorShotsMultiple(fb, params):
+    """Fire overlapping pairs of shots, the second one a second after the first."""
+    shots = Compositor(fb)
+    t = yield
+    while True:
+        shots.clear()
+        shots.add(_shot(fb, params))
+        shots.add(_shot(fb, params), delay_ms=1000)
+        t = yield from shots.play(t)
+
+
+class _Drop(Sprite):
+    '''
+    One drop of melt. The lit section extends from anchor, the tip breaks off
+    and falls to the floor while the extension retracts, and the drop lands as
+    a two pixel pile. Delays are read from params on every frame.
+    '''
+
+    def __init__(self, rgb, anchor, length, step, floor, params):
+        self.rgb = rgb
+        self.anchor = anchor
+        self.length = length
+        self.step = step
+        self.params = params
+        # The tip is the two pixels beyond the extension; it falls until it reaches the pile
+        self.positions = range(anchor + step * (length + 2), floor - 2 * step, step)
+        self.pile = slice(floor - 2, floor) if step > 0 else slice(floor, floor + 2)
+        self.extend = Stepper()
+        self.fall = None
+        self.retract = Stepper()
+        self.extended = 0
+        self.drop = None
+
+    def update(self, t):
+        params = self.params
+        if self.fall is None:
+            k = self.extend(t, params["delay_ms"])
+            self.extended = min(k + 1, self.length + 2)
+            if k < self.length + 2:
+                return True
+            self.fall = Stepper()
+        # The drop falls while the extension retracts
+        k = self.fall(t, params["drip_delay_ms"])
+        self.drop = self.positions[k] if k < len(self.positions) else None
+        retracted = self.retract(t, params["off_delay_ms"]) + 1
+        self.extended = max(self.length - retracted + 1, 0)
+        return self.drop is not None or self.extended > 0
+
+    def draw(self, paint):
+        if self.extended:
+            if self.step > 0:
+                paint(slice(self.anchor, self.anchor + self.extended), self.rgb)
+            else:
+                paint(slice(max(self.anchor - self.extended + 1, 0), self.anchor + 1), self.rgb)
+        if self.drop is not None:
+            i = self.drop
+            paint(slice(max(min(i, i - self.step), 0), max(i, i - self.step) + 1), self.rgb)
+        elif self.fall is not None:
+            paint(self.pile, self.rgb)
+
+
+def melt(fb, params):
+    """Melt from the lit midsection to the sides"""
+    n = len(fb)
+    top = fb.layout.segments.get("top")  # The segment above the door
+    start, end = (top.start, top.stop) if top is not None else (int(n / 2 - 59 // 2), int(n / 2 + 50 // 2))
+    direction = "left"
+    drops = Compositor(fb)
+    t = yield
+    while True:
+        rgb = randomRGB()
+        cum_height_right = 0  # Height of the accumulation
+        cum_height_left = 0
+        drops.clear()
+        drops.base[start:end] = rgb
+        t = yield from drops.play(t)
+        t = yield from hold(t, params["delay_ms"])
+        for l in range(80, 1, -1):  # So that the length of the extension is shorter on each drop
+            if direction == "right":
+                drops.add(_Drop(rgb, end, l, 1, n - cum_height_right, params))
+                cum_height_right += 2
+            else:
+                # Same as above, but mirrored and defined with regard to "start" rather than "end"
+                drops.add(_Drop(rgb, start, l, -1, cum_height_left, params))
+                cum_height_left += 2
+            t = yield from drops.play(t)
+            direction = random.choice(["left", "right"])
@@ -0,0 +1,167 @@
+'''
+Opt-in sampling profiler for the render loop.
+
+Nothing is measured until a profile is started, at runtime, with the
+daemon's "profile" command (or /profile/start on the web apps). For a
+bounded window a CPU-time interval timer (SIGPROF) then interrupts the
+render loop every SAMPLE_INTERVAL_S of CPU time, and the handler records
+the Python stack it interrupted, filed under the pattern that was running.
+Optionally tracemalloc runs for the same window. When the window ends, two
+files are written next to PROFILE_PATH:
+
+- PROFILE_PATH + ".txt": a report per pattern of the functions with the most
+  samples, as estimated time spent in the function itself and including
+  what it calls, plus the lines that allocated the most memory;
+- PROFILE_PATH + ".folded": the samples as collapsed stacks, one
+  ``pattern;frame;frame;... count`` line per distinct stack, for
+  flamegraph.pl, speedscope or inferno.
+
+Because the timer counts CPU time, samples land where frames spend it and
+not in the sleep between ticks. Signal handlers only run on the main
+thread, so the render loop must run there, as it does in led_daemon.py and
+led.py, and the profile must be started and stopped from it (the daemon
+does both in poll()). Samples taken while the loop was asleep, charged to
+it for another thread's CPU time, are counted as idle and left out of the
+report's percentages.
+'''
+import collections
+import os
+import signal
+import threading
+import time
+import tracemalloc
+
+PROFILE_PATH = os.environ.get("PILED_PROFILE", "/tmp/piled-profile")
+SAMPLE_INTERVAL_S = 0.001
+MAX_SECONDS = 60
+TOP_FUNCTIONS = 15
+TOP_ALLOCATIONS = 15
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+class Profiler:
+    '''
+    Parameters:
+    led: LED instance
+        Its renderer is sampled and its current_pattern labels the samples
+    path: str
+        Where the report and collapsed stacks are written, without extension
+    '''
+
+    def __init__(self, led, path=PROFILE_PATH):
+        self.led = led
+        self.path = path
+        self.end = None  # Monotonic end of the running window
+        self.stacks = None
+        self._allocations = False
+        self._stop_code = type(led.renderer).run.__code__
+
+    @property
+    def running(self):
+        return self.end is not None
+
+    def start(self, seconds=10, allocations=False):
+        '''
+        Profile the next `seconds` (at most MAX_SECONDS), optionally tracing
+        allocations too. Call from the render thread. Raises ValueError if a
+        profile is already running.
+        '''
+        if self.running:
+            raise ValueError("A profile is already running")
+        seconds = float(seconds)
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {MAX_SECONDS}")
+        if threading.current_thread() is not threading.main_thread():
+            raise ValueError("Profiling needs the render loop on the main thread")
+        for extension in (".txt", ".folded"):
+            if os.path.exists(self.path + extension):
+                os.unlink(self.path + extension)  # Stale until this profile is written
+        renderer = self.led.renderer
+        self.stacks = collections.Counter()  # (pattern, frame names root first) -> samples
+        self._before = (time.monotonic(), renderer.frames, renderer.dropped, renderer.metrics.compute.sum)
+        self._allocations = bool(allocations)
+        if self._allocations:
+            tracemalloc.start()
+        self.end = time.monotonic() + seconds
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL_S, SAMPLE_INTERVAL_S)
+
+    def stop(self):
+        '''End the running profile early. Its results are still written. Call from the render thread.'''
+        if self.running:
+            self._finish()
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame.f_code))
+            if frame.f_code is self._stop_code:
+                break  # Leave out whatever called the render loop
+            frame = frame.f_back
+        self.stacks[(self.led.current_pattern, tuple(reversed(names)))] += 1
+        if time.monotonic() >= self.end:
+            self._finish()
+
+    def _finish(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)  # A signal already on its way is dropped
+        snapshot = None
+        if self._allocations:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        renderer = self.led.renderer
+        started, frames_before, dropped_before, compute_before = self._before
+        frames = renderer.frames - frames_before
+        summary = (f"{time.monotonic() - started:.1f} s, {sum(self.stacks.values())} samples every "
+                   f"{SAMPLE_INTERVAL_S * 1000:g} ms of CPU time, {frames} frames, "
+                   f"{renderer.dropped - dropped_before} dropped, mean compute "
+                   f"{(renderer.metrics.compute.sum - compute_before) / max(frames, 1) * 1000:.3f} ms")
+        # Formatting the report would hold up the render loop, so do it on the side
+        threading.Thread(target=self._write, daemon=True,
+                         args=(self.stacks, snapshot, summary, _frame_name(threading.Event.wait.__code__))).start()
+        self.end = None
+
+    def _write(self, stacks, snapshot, summary, sleep_name):
+        with open(self.path + ".folded.tmp", "w") as f:
+            for (pattern, names), count in stacks.most_common():
+                f.write(f"{';'.join((pattern,) + names)} {count}\n")
+
+        lines = [f"Profile: {summary}", ""]
+        by_pattern = collections.defaultdict(collections.Counter)
+        for (pattern, names), count in stacks.items():
+            by_pattern[pattern][names] += count
+        for pattern, pattern_stacks in by_pattern.items():
+            own, inclusive = collections.Counter(), collections.Counter()
+            idle = 0
+            for names, count in pattern_stacks.items():
+                if len(names) > 1 and names[1] == sleep_name:
+                    idle += count  # The render loop's tick sleep
+                    continue
+                own[names[-1]] += count
+                for name in set(names):
+                    inclusive[name] += count
+            total = max(sum(own.values()), 1)
+            lines += [f"{pattern}: {sum(own.values())} busy samples, ~{total * SAMPLE_INTERVAL_S * 1000:.0f} ms, "
+                      f"{idle} idle",
+                      f"  {'self ms':>9} {'self %':>7} {'total ms':>9} {'total %':>8}  function"]
+            for name, count in own.most_common(TOP_FUNCTIONS):
+                lines.append(f"  {count * SAMPLE_INTERVAL_S * 1000:>9.1f} {100 * count / total:>7.1f} "
+                             f"{inclusive[name] * SAMPLE_INTERVAL_S * 1000:>9.1f} "
+                             f"{100 * inclusive[name] / total:>8.1f}  {name}")
+            lines.append("")
+        if snapshot is not None:
+            statistics = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")
+            lines += ["Largest live allocations at the end of the window, by line:",
+                      f"  {'KiB':>9} {'blocks':>8}  line"]
+            for stat in statistics[:TOP_ALLOCATIONS]:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size / 1024:>9.1f} {stat.count:>8}  "
+                             f"{os.path.basename(frame.filename)}:{frame.lineno}")
+        with open(self.path + ".txt.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        # The report appears last, so its presence means both files are complete
+        os.replace(self.path + ".folded.tmp", self.path + ".folded")
+        os.replace(self.path + ".txt.tmp", self.path + ".txt")
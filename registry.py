@@ -0,0 +1,190 @@
+'''
+Registry of the patterns that can be started by name.
+
+Each pattern is declared once here with its parameters: their type, default
+and allowed range. The daemon, the web app, the led.py CLI and the benchmark
+all look patterns up in PATTERNS and validate parameters through it, and the
+web app serves describe() at /patterns so the UI can build its controls.
+'''
+import math
+
+import patterns
+
+
+class Param:
+    '''
+    One pattern parameter.
+
+    Parameters:
+    name: str
+        Keyword the pattern reads from its params dict
+    kind: str
+        "int", "float" or "rgb" (three ints between 0 and 255)
+    default:
+        Value used when the parameter is not given
+    min, max: number
+        Inclusive range of allowed values, if any
+    '''
+
+    def __init__(self, name, kind, default, min=None, max=None):
+        self.name = name
+        self.kind = kind
+        self.default = default
+        self.min = min
+        self.max = max
+
+    def parse(self, value):
+        '''Convert value (possibly a query string) to the parameter's type. Raises ValueError if invalid.'''
+        if self.kind == "rgb":
+            if isinstance(value, str):
+                value = value.split(",")
+            try:
+                rgb = tuple(int(c) for c in value)
+            except OverflowError:
+                rgb = ()  # int() of an infinite float, e.g. 1e999 in JSON; reported as out of range
+            if len(rgb) != 3 or not all(0 <= c <= 255 for c in rgb):
+                raise ValueError(f"{self.name} must be three values between 0 and 255")
+            return rgb
+        try:
+            value = int(value) if self.kind == "int" else float(value)
+        except OverflowError:
+            value = math.inf  # int() of an infinite float, e.g. 1e999 in JSON
+        if not math.isfinite(value):
+            raise ValueError(f"{self.name} must be a finite number")
+        if (self.min is not None and value < self.min) or (self.max is not None and value > self.max):
+            raise ValueError(f"{self.name} must be between {self.min} and {self.max}")
+        return value
+
+    def describe(self):
+        return {"name": self.name, "type": self.kind, "default": self.default,
+                "min": self.min, "max": self.max}
+
+
+class Pattern:
+    '''
+    A pattern that can be started by name.
+
+    Parameters:
+    name: str
+        Name used by the UI, the CLI and daemon commands
+    function: generator function
+        The pattern in patterns.py
+    label: str
+        Button text in the UI
+    params: tuple of Param
+    static: bool
+        True if the pattern draws the same frame forever, so one frame is enough
+    deterministic: bool
+        True if each frame depends only on the time and params, so frames can
+        be rendered ahead of time and cached
+    '''
+
+    def __init__(self, name, function, label, params=(), static=False, deterministic=False):
+        self.name = name
+        self.function = function
+        self.label = label
+        self.params = {param.name: param for param in params}
+        self.static = static
+        self.deterministic = deterministic
+
+    def bind(self, *args, **kwargs):
+        '''
+        Validate arguments, given positionally in declaration order or by
+        keyword, and return the full params dict with defaults filled in.
+        Raises ValueError for unknown, duplicate or invalid parameters.
+        '''
+        if len(args) > len(self.params):
+            raise ValueError(f"{self.name} takes at most {len(self.params)} parameters")
+        for name, value in zip(self.params, args):
+            if name in kwargs:
+                raise ValueError(f"{self.name} got {name} twice")
+            kwargs[name] = value
+        unknown = kwargs.keys() - self.params.keys()
+        if unknown:
+            raise ValueError(f"{self.name} does not take {', '.join(sorted(unknown))}")
+        bound = {name: param.parse(kwargs[name]) if name in kwargs else param.default
+                 for name, param in self.params.items()}
+        for name in bound:
+            # Ranges given as <x>_min / <x>_max pairs must be ordered
+            if name.endswith("_min") and bound[name] > bound.get(name[:-4] + "_max", bound[name]):
+                raise ValueError(f"{name} must not exceed {name[:-4]}_max")
+        return bound
+
+    def describe(self):
+        return {"name": self.name, "label": self.label, "doc": self.function.__doc__,
+                "params": [param.describe() for param in self.params.values()],
+                "static": self.static, "deterministic": self.deterministic}
+
+
+def delay_ms(default):
+    return Param("delay_ms", "int", default, 1, 1000)
+
+
+RGB = Param("rgb", "rgb", (127, 127, 127))
+BRIGHTNESS = Param("brightness", "float", 1.0, 0, 1)
+
+# What /params may change on whichever pattern is running
+LIVE_PARAMS = {param.name: param for param in (RGB, delay_ms(None), BRIGHTNESS)}
+
+
+def _shots(delay_ms_min, delay_ms_max):
+    return (Param("min", "int", 20, 0, 1000),
+            Param("length", "int", 5, 1, 100),
+            Param("delay_ms_min", "int", delay_ms_min, 1, 1000),
+            Param("delay_ms_max", "int", delay_ms_max, 1, 1000))
+
+
+def _audio():
+    return (Param("gain", "float", 1.0, 0.1, 10),  # Scales the band levels before they are clipped
+            Param("release_ms", "int", 150, 1, 2000))  # How long a level takes to fall back
+
+
+PATTERNS = {pattern.name: pattern for pattern in (
+    Pattern("solidColor", patterns.solidColor, "Solid Color", (RGB,), static=True, deterministic=True),
+    Pattern("colorWipe", patterns.colorWipe, "Color Wipe", (RGB, delay_ms(50)), deterministic=True),
+    Pattern("theaterChase", patterns.theaterChase, "Theater Chase",
+            (Param("rgb", "rgb", (255, 255, 255)), delay_ms(50)), deterministic=True),
+    Pattern("theaterChaseRainbow", patterns.theaterChaseRainbow, "Theater Chase Rainbow", (delay_ms(50),),
+            deterministic=True),
+    Pattern("rainbowWipe", patterns.rainbowWipe, "Rainbow Wipe", (delay_ms(35),), deterministic=True),
+    Pattern("rainbowWipeAlwaysOn", patterns.rainbowWipeAlwaysOn, "Rainbow Wipe Always On", (delay_ms(20),)),
+    Pattern("randomWipe", patterns.randomWipe, "Random Wipe", (delay_ms(35),)),
+    Pattern("rainbowCycle", patterns.rainbowCycle, "Rainbow Cycle", (delay_ms(20),), deterministic=True),
+    Pattern("rainbow", patterns.rainbow, "Rainbow", (delay_ms(20),), deterministic=True),
+    Pattern("colorShots", patterns.colorShots, "Single Color Shots", _shots(10, 30)),
+    Pattern("colorShotsMultiple", patterns.colorShotsMultiple, "Color Shots", _shots(5, 20)),
+    Pattern("melt", patterns.melt, "Melt",
+            (delay_ms(60),  # Speed of the downward extension
+             Param("off_delay_ms", "int", 30, 1, 1000),  # Speed of return
+             Param("drip_delay_ms", "int", 20, 1, 1000))),  # Speed of the drop
+    Pattern("gradient", patterns.gradient, "Gradient",
+            (Param("rgb", "rgb", (255, 0, 0)), Param("top_rgb", "rgb", (0, 0, 255))),
+            static=True, deterministic=True),
+    Pattern("rainbowRise", patterns.rainbowRise, "Rainbow Rise", (delay_ms(20),), deterministic=True),
+    Pattern("audioSpectrum", patterns.audioSpectrum, "Audio Spectrum", _audio()),
+    Pattern("audioPulse", patterns.audioPulse, "Audio Pulse", _audio()),
+    Pattern("clear", patterns.clear, "Clear", static=True, deterministic=True),
+)}
+
+
+def get(name):
+    '''Look up a pattern by name. Raises ValueError if there is none.'''
+    try:
+        return PATTERNS[name]
+    except KeyError:
+        raise ValueError(f"Invalid program {name!r}") from None
+
+
+def describe():
+    '''JSON-serializable listing of every pattern and its parameters.'''
+    return [pattern.describe() for pattern in PATTERNS.values()]
+
+
+def parse_live(params):
+    '''Validate an update for the running pattern. Raises ValueError for unknown or invalid params.'''
+    if not isinstance(params, dict):
+        raise ValueError("params must be an object")
+    unknown = params.keys() - LIVE_PARAMS.keys()
+    if unknown:
+        raise ValueError(f"Unknown parameter {', '.join(sorted(unknown))}")
+    return {key: LIVE_PARAMS[key].parse(value) for key, value in params.items()}
@@ -0,0 +1,239 @@
+import functools
+import threading
+import time
+import traceback
+
+from metrics import Metrics
+
+
+class CancelToken:
+    '''
+    Handle on a started pattern, used to stop it cooperatively.
+
+    cancel() may be called from any thread. The render loop checks the token
+    at every frame boundary and closes the pattern generator there, never in
+    the middle of a frame or a show(). Cancelling also wakes the render loop
+    from its tick sleep, so the switch happens within one frame.
+    '''
+
+    def __init__(self, wake):
+        self._cancelled = threading.Event()
+        self._closed = threading.Event()
+        self._wake = wake
+        self.cancelled_ns = None
+        self.closed_ns = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        if not self._cancelled.is_set():
+            self.cancelled_ns = time.monotonic_ns()
+            self._cancelled.set()
+            self._wake.set()
+
+    def wait(self, timeout=None):
+        '''Block until the render loop has closed the pattern.'''
+        return self._closed.wait(timeout)
+
+    def _close(self, pattern):
+        pattern.close()
+        self.closed_ns = time.monotonic_ns()
+        self._closed.set()
+
+
+class Renderer:
+    '''
+    Fixed frame rate render loop.
+
+    Each tick the active pattern is asked for the frame at time t (seconds
+    since the pattern started), the framebuffer is committed and show() is
+    called exactly once, unless the frame did not change, in which case
+    both are skipped. Ticks are scheduled against absolute deadlines from
+    time.monotonic_ns, so render cost does not accumulate as drift. When the
+    loop falls more than a whole frame behind, the missed ticks are dropped
+    and the next frame is rendered for the current deadline instead.
+
+    Each frame's compute, commit and show() times, and how late each tick
+    sleep woke up, are recorded in self.metrics.
+
+    A pattern that raises is logged to stderr and stopped as if it had
+    finished, so one broken pattern cannot stop the loop.
+    '''
+
+    def __init__(self, led, fps=60, poll=None, on_frame=None):
+        self.led = led
+        self.fps = fps
+        self.period_ns = int(1e9 / fps)
+        self.poll = poll
+        self.on_frame = on_frame
+        self.pattern = None
+        self.token = None
+        self.pattern_start = None
+        self.frames = 0
+        self.changed = False  # Whether the last frame differed from the one before
+        self.dropped = 0
+        self.last_frame_ns = 0
+        self.measured_fps = 0.0
+        self._mean_interval_ns = 0.0
+        self.metrics = Metrics()
+        self.thread_id = None  # Of the thread running the loop, for the profiler
+        self._pending = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def set_pattern(self, pattern, transition=None):
+        '''
+        Switch to a new pattern generator. Safe to call from any thread.
+
+        The current pattern is cancelled and the new one renders its first
+        frame (t=0) on the next tick. Returns the new pattern's CancelToken.
+
+        With a transition, the cancelled pattern is handed over rather than
+        closed: at the frame boundary ``transition(pattern, outgoing, release,
+        elapsed)`` is called with the running generator (or None), a callable
+        that closes it and settles its token, and the seconds it has run for,
+        and the generator it returns runs in place of pattern.
+        '''
+        token = CancelToken(self._wake)
+        with self._lock:
+            self._cancel_locked()
+            if self._pending is not None:
+                # Replaced before it ever started, so the frame boundary will never see it
+                superseded, superseded_token, _ = self._pending
+                superseded_token._close(superseded)
+            self._pending = (pattern, token, transition)
+        self._wake.set()
+        return token
+
+    def wake(self):
+        '''Cut the current tick sleep short, e.g. because a command has arrived. Safe to call from any thread.'''
+        self._wake.set()
+
+    def stop(self):
+        '''Cancel the active pattern; the strip holds its last frame.'''
+        with self._lock:
+            self._cancel_locked()
+
+    def _cancel_locked(self):
+        if self._pending is not None:
+            self._pending[1].cancel()
+        if self.token is not None:
+            self.token.cancel()
+
+    def _frame_boundary(self):
+        '''Apply pending switches and cancellations. Only called between frames.'''
+        # Hold the lock throughout, so stop() can't slip in after the old
+        # pattern is closed but before the new one is installed
+        with self._lock:
+            pending, self._pending = self._pending, None
+            handover = (None, None, 0.0)
+            if self.token is not None and self.token.cancelled:
+                if pending is not None and pending[2] is not None and not pending[1].cancelled:
+                    elapsed = 0.0
+                    if self.pattern_start is not None:
+                        elapsed = (time.monotonic_ns() - self.pattern_start) / 1e9
+                    handover = (self.pattern, functools.partial(self.token._close, self.pattern), elapsed)
+                else:
+                    self.token._close(self.pattern)
+                self.pattern = self.token = None
+            if pending is not None:
+                pattern, token, transition = pending
+                if token.cancelled:
+                    token._close(pattern)
+                else:
+                    if transition is not None:
+                        pattern = transition(pattern, *handover)
+                    try:
+                        next(pattern)
+                    except Exception:
+                        traceback.print_exc()  # Broken before its first frame; drop it
+                        token._close(pattern)
+                        return
+                    self.pattern, self.token = pattern, token
+                    self.pattern_start = None
+
+    def render_frame(self, t_ns):
+        '''
+        Render and show one frame for the monotonic time t_ns.
+
+        Returns False if there was no pattern to render.
+        '''
+        self._frame_boundary()
+        if self.pattern is None:
+            return False
+        if self.pattern_start is None:
+            self.pattern_start = t_ns
+        started = time.monotonic_ns()
+        try:
+            self.pattern.send((t_ns - self.pattern_start) / 1e9)
+        except StopIteration:
+            self.token._close(self.pattern)
+            self.pattern = self.token = None
+            return False
+        except Exception:
+            # A pattern bug stops that pattern, holding its last frame, not the render loop
+            traceback.print_exc()
+            self.token._close(self.pattern)
+            self.pattern = self.token = None
+            return False
+        computed = time.monotonic_ns()
+        self.changed = self.led.commit()
+        committed = time.monotonic_ns()
+        self.led.latch(self.changed)
+        shown = time.monotonic_ns()
+        self.metrics.frame(computed - started, committed - computed, shown - committed, shown)
+        self._count_frame(shown)
+        return True
+
+    def run(self, frames=None):
+        '''
+        Render the active pattern, one show() per tick.
+
+        Parameters:
+        frames: int
+            Stop after this many ticks. Runs forever if None.
+
+        Without a poll callback the loop returns when there is no pattern
+        left to render; with one it keeps ticking, holding the last frame
+        until poll() sets a new pattern.
+        '''
+        self.thread_id = threading.get_ident()
+        deadline = time.monotonic_ns()
+        ticks = 0
+        while frames is None or ticks < frames:
+            if self.poll is not None:
+                self.poll()
+            if not self.render_frame(deadline) and self.poll is None and self._pending is None:
+                return
+            ticks += 1
+
+            deadline += self.period_ns
+            now = time.monotonic_ns()
+            behind = (now - deadline) // self.period_ns
+            if behind > 0:
+                self.dropped += behind
+                deadline += behind * self.period_ns
+            # Sleep until the deadline, but wake early for a switch, cancel or command.
+            # The early frame is rendered for now, and the cadence carries on from it.
+            if deadline > now:
+                if self._wake.wait((deadline - now) / 1e9):
+                    deadline = time.monotonic_ns()
+                else:
+                    self.metrics.jitter.observe(max(time.monotonic_ns() - deadline, 0) / 1e9)
+            self._wake.clear()
+
+    def _count_frame(self, now):
+        if self.last_frame_ns:
+            # Exponential moving average of the frame interval over roughly the last 30 frames
+            interval = now - self.last_frame_ns
+            if self._mean_interval_ns:
+                self._mean_interval_ns += (interval - self._mean_interval_ns) / 30
+            else:
+                self._mean_interval_ns = interval
+            self.measured_fps = 1e9 / max(self._mean_interval_ns, 1)
+        self.last_frame_ns = now
+        self.frames += 1
+        if self.on_frame is not None:
+            self.on_frame()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+'''
+Timeline sequencer.
+
+A Timeline plays registered patterns one after another, each for a set
+duration, crossfading from one into the next. Segments of deterministic
+patterns (flagged in the registry) can be pre-rendered: compile() renders
+such a segment once, at the render loop's frame rate, into a .npy file under
+CACHE_DIR and memory-maps it, so playing it back is one copy per frame out
+of the page cache instead of running the pattern. A cached segment may be
+at most MAX_CACHE_SECONDS long, and after each compile the least recently
+used files are deleted until the cache fits in MAX_CACHE_BYTES.
+
+Timelines are written as JSON:
+
+    {"loop": true, "segments": [
+        {"pattern": "rainbowCycle", "duration": 30, "cache": true},
+        {"pattern": "colorWipe", "params": {"rgb": [255, 0, 0]}, "duration": 10, "fade": 2},
+        {"pattern": "theaterChaseRainbow", "duration": 20, "fade": 2, "transition": "wipe", "cache": true}]}
+
+A segment starts when the one before it has played for its duration, and
+blends in over its "fade" seconds while the one before keeps running
+underneath, as a crossfade or another "transition" from transitions.py. The last segment of a timeline that does not loop may leave
+out its duration to play forever.
+
+    python sequencer.py show.json            # compile and play
+    python sequencer.py show.json --compile  # only fill the frame cache
+'''
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import registry
+import transitions
+from framebuffer import FrameBuffer
+
+NAME = "timeline"  # current_pattern while a timeline plays
+CACHE_DIR = os.environ.get("PILED_CACHE", os.path.expanduser("~/.cache/piled"))
+MAX_CACHE_SECONDS = 600.0  # Longest segment that can be cached, including the fade into the next
+MAX_CACHE_BYTES = int(os.environ.get("PILED_CACHE_MB", "512")) * 2**20
+# Segment timings are parsed like pattern params, so non-finite values are rejected; Segment checks the ranges
+DURATION = registry.Param("duration", "float", None)
+FADE = registry.Param("fade", "float", 0.0)
+
+
+class Segment:
+    '''
+    One pattern on a timeline.
+
+    Parameters:
+    name: str
+        Registered pattern name
+    params: dict
+        Pattern params, validated and completed through the registry
+    duration: float
+        Seconds until the next segment starts. None plays forever
+    fade: float
+        Seconds this segment takes to blend in over the previous one
+    cache: bool
+        Pre-render the segment into the frame cache. Only deterministic
+        patterns with a duration can be cached
+    transition: str
+        How it blends in, one of transitions.KINDS
+    '''
+
+    def __init__(self, name, params=None, duration=None, fade=0.0, cache=False, transition="fade"):
+        self.pattern = registry.get(name)
+        self.params = self.pattern.bind(**(params or {}))
+        try:
+            self.duration = None if duration is None else DURATION.parse(duration)
+            self.fade = FADE.parse(fade)
+        except ValueError as e:
+            raise ValueError(f"{name} {e}") from None
+        self.cache = cache
+        self.transition = transition
+        self.frames = None  # Memory-mapped (frames, N, 3) array once compiled
+        self.fps = None
+        if self.duration is not None and self.duration <= 0:
+            raise ValueError(f"{name} duration must be positive")
+        if self.fade < 0 or (self.duration is not None and self.fade > self.duration):
+            raise ValueError(f"{name} fade must be between 0 and its duration")
+        if cache and not self.pattern.deterministic:
+            raise ValueError(f"{name} is not deterministic, so it cannot be cached")
+        if cache and self.duration is None:
+            raise ValueError(f"{name} needs a duration to be cached")
+        if transition not in transitions.KINDS:
+            raise ValueError(f"{name} transition must be one of {', '.join(transitions.KINDS)}")
+
+
+class Timeline:
+    '''
+    Parameters:
+    segments: list of Segment
+    loop: bool
+        Start again from the first segment after the last, fading into it
+    '''
+
+    def __init__(self, segments, loop=False):
+        if not segments:
+            raise ValueError("A timeline needs at least one segment")
+        if any(segment.duration is None for segment in segments[:-1]) or (loop and segments[-1].duration is None):
+            raise ValueError("Only the last segment of a timeline that does not loop may play forever")
+        self.segments = segments
+        self.loop = loop
+        for index, segment in enumerate(segments):
+            if segment.cache and self._cached_seconds(index) > MAX_CACHE_SECONDS:
+                raise ValueError(f"{segment.pattern.name} is too long to cache, at most {MAX_CACHE_SECONDS:g} s "
+                                 "including the fade into the next segment")
+
+    @classmethod
+    def from_json(cls, data):
+        '''Build a timeline from its JSON form. Raises ValueError if it is invalid.'''
+        try:
+            segments = [Segment(entry["pattern"], entry.get("params"), entry.get("duration"),
+                                entry.get("fade", 0.0), entry.get("cache", False),
+                                entry.get("transition", "fade"))
+                        for entry in data["segments"]]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid timeline: {e}") from None
+        return cls(segments, bool(data.get("loop", False)))
+
+    def _next(self, index):
+        '''Index of the segment after index, or None at the end.'''
+        if index + 1 < len(self.segments):
+            return index + 1
+        return 0 if self.loop else None
+
+    def _cached_seconds(self, index):
+        '''How long a cached segment is rendered for: its duration plus the fade of the one after it.'''
+        after = self._next(index)
+        return self.segments[index].duration + (self.segments[after].fade if after is not None else 0.0)
+
+    def compile(self, num_pixels, fps, cache_dir=CACHE_DIR, layout=None):
+        '''
+        Render every cached segment into the frame cache, unless it is there
+        already, and map it. A segment is rendered for its duration plus the
+        fade of the segment after it, during which it is still visible, on
+        the given layout.Layout, or a straight line if None. Then prunes
+        the cache, keeping this timeline's files.
+        '''
+        os.makedirs(cache_dir, exist_ok=True)
+        keep = set()
+        for index, segment in enumerate(self.segments):
+            if not segment.cache:
+                continue
+            frames = int(self._cached_seconds(index) * fps) + 1
+            key = json.dumps([segment.pattern.name, sorted(segment.params.items()), fps, num_pixels, frames,
+                              layout.key() if layout is not None else None])
+            path = os.path.join(cache_dir, f"{segment.pattern.name}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy")
+            if os.path.exists(path):
+                os.utime(path)  # Mark it used, for _prune
+            else:
+                _render_to(path, segment, num_pixels, fps, frames, layout)
+            segment.frames = np.load(path, mmap_mode="r")
+            segment.fps = fps
+            keep.add(path)
+        _prune(cache_dir, keep)
+
+    def play(self, fb, params):
+        '''Pattern generator for the whole timeline. Call compile() first to use the frame cache.'''
+        n = len(fb)
+        blend = transitions.Blend(n)
+        index = 0
+        t = yield
+        current, previous = _Layer(self.segments[0], fb.layout, t), None
+        try:
+            while True:
+                # Move on to every segment that has started by now; more than one if frames were dropped
+                segment = self.segments[index]
+                while segment.duration is not None and t >= current.start + segment.duration:
+                    after = self._next(index)
+                    if after is None:
+                        return  # The strip holds the last frame
+                    if previous is not None:
+                        previous.close()
+                    start = current.start + segment.duration
+                    index, segment = after, self.segments[after]
+                    previous, current = current, _Layer(segment, fb.layout, start)
+                if previous is not None and t >= current.start + segment.fade:
+                    previous.close()
+                    previous = None
+
+                pixels = current.render(t)
+                if previous is None:
+                    fb[:] = pixels
+                else:
+                    fb[:] = blend(segment.transition, previous.render(t), pixels, (t - current.start) / segment.fade)
+                t = yield
+        finally:
+            current.close()
+            if previous is not None:
+                previous.close()
+
+
+class _Layer:
+    '''A segment playing from timeline time start, either live into its own framebuffer or from its cached frames.'''
+
+    def __init__(self, segment, layout, start):
+        self.segment = segment
+        self.start = start
+        self.fb = self.pattern = None
+        if segment.frames is None:
+            self.fb = FrameBuffer(len(layout), layout=layout)
+            self.pattern = segment.pattern.function(self.fb, dict(segment.params))
+            next(self.pattern)
+
+    def render(self, t):
+        frames = self.segment.frames
+        if frames is not None:
+            # Latest frame rendered at or before t; the epsilon absorbs float error in k / fps
+            return frames[min(int((t - self.start) * self.segment.fps + 1e-6), len(frames) - 1)]
+        try:
+            self.pattern.send(t - self.start)
+        except StopIteration:
+            pass  # Finished early; hold its last frame
+        return self.fb.pixels
+
+    def close(self):
+        if self.pattern is not None:
+            self.pattern.close()
+
+
+def _render_to(path, segment, num_pixels, fps, frames, layout=None):
+    '''Render frames of a segment at fps into a .npy file, written under a temporary name first.'''
+    fb = FrameBuffer(num_pixels, layout=layout)
+    pattern = segment.pattern.function(fb, dict(segment.params))
+    next(pattern)
+    # A name of its own, so two compiles of the same segment cannot write into each other's file
+    fd, tmp = tempfile.mkstemp(suffix=".npy", prefix=".tmp-", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.uint8, shape=(frames, num_pixels, 3))
+        for k in range(frames):
+            try:
+                pattern.send(k / fps)
+            except StopIteration:
+                out[k:] = fb.pixels
+                break
+            out[k] = fb.pixels
+        out.flush()
+        del out
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    finally:
+        pattern.close()
+
+
+def _prune(cache_dir, keep=()):
+    '''
+    Delete the least recently used cache files until the rest fit in
+    MAX_CACHE_BYTES, sparing the paths in keep. Temporary files of renders
+    in progress start with a dot and are left alone. A deleted file stays
+    readable through any existing memory map of it.
+    '''
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".npy") and not entry.name.startswith(".") and entry.path not in keep:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Pruned by another compile
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries) + sum(os.path.getsize(path) for path in keep)
+    for _, size, path in sorted(entries):
+        if total <= MAX_CACHE_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play a timeline of patterns")
+    parser.add_argument("timeline", help="Timeline JSON file")
+    parser.add_argument("--compile", action="store_true", help="Only render the cached segments, then exit")
+    parser.add_argument("--brightness", type=float, help="The brightness scale", default=1.0)
+    args = parser.parse_args()
+
+    from led import LED
+    with open(args.timeline) as f:
+        try:
+            timeline = Timeline.from_json(json.load(f))
+        except ValueError as e:
+            parser.error(str(e))
+    led = LED(args.brightness)
+    if args.compile:
+        timeline.compile(len(led.fb), led.renderer.fps, layout=led.fb.layout)
+        raise SystemExit
+    try:
+        led.play_timeline(timeline)
+        led.renderer.run()
+    except KeyboardInterrupt:
+        led.clear()
+        raise SystemExit
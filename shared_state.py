@@ -0,0 +1,248 @@
+'''
+Live renderer state published through shared memory.
+
+The daemon is the only writer. It updates a fixed-layout block after every
+frame under a sequence lock: the sequence number is odd while a write is in
+progress and is bumped back to even when it is done. Readers copy the block
+and retry if the sequence was odd or changed underneath them, so any number
+of web workers can read without locks or round trips to the daemon.
+
+A daemon that starts, or stops, retires the blocks it replaces by setting
+their sequence to RETIRED before unlinking them. Readers still mapping a
+retired block attach again by name, so a respawned daemon's state reaches
+web workers that were reading the old one.
+'''
+import json
+import os
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import metrics
+
+STATE_NAME = os.environ.get("PILED_STATE", "piled_state")
+MAX_PIXELS = 4096
+RETIRED = 2**64 - 1  # Sequence of a block its daemon has given up; odd, so readers never take a copy
+
+# seq, frames, dropped, last_frame_ns, fps, brightness, commands received, merged and dropped,
+# pattern, params length, params JSON
+_SEQ = struct.Struct("<Q")
+_LAYOUT = struct.Struct("<QQQqddQQQ32sH1024s")
+_COUNTERS = struct.Struct("<QQqddQQQ")
+_COUNTERS_OFFSET = _SEQ.size
+_PATTERN_OFFSET = _COUNTERS_OFFSET + _COUNTERS.size
+_PARAMS = struct.Struct("<H1024s")
+_PARAMS_OFFSET = _PATTERN_OFFSET + 32
+MAX_PARAMS_BYTES = 1024
+
+# The last frame sent to the strip lives in its own block, under its own
+# sequence lock, so the once-per-frame copy does not make state readers retry.
+# seq, frame number, pixel count, then the packed 0x00RRGGBB pixels
+_FRAME = struct.Struct("<QQI")
+_FRAME_SIZE = _FRAME.size + 4 * MAX_PIXELS
+
+# Render metrics get a third block, also under its own sequence lock: seq, then
+# a float64 row of bucket counts and sum per histogram, as from Metrics.values()
+_METRICS_SHAPE = (len(metrics.HISTOGRAMS), len(metrics.BUCKETS) + 2)
+_METRICS_SIZE = _SEQ.size + 8 * _METRICS_SHAPE[0] * _METRICS_SHAPE[1]
+
+
+def _create(name, size):
+    '''
+    Create a block, retiring one left by an earlier daemon. The block is
+    kept from the resource tracker, which would unlink it if the daemon
+    crashed, before the next daemon could retire it.
+    '''
+    try:
+        stale = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        pass
+    else:
+        _retire(stale)
+        stale.close()
+        stale.unlink()
+    shm = shared_memory.SharedMemory(name, create=True, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _retire(shm):
+    if shm.size >= _SEQ.size:
+        _SEQ.pack_into(shm.buf, 0, RETIRED)
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name)
+    # The daemon owns the segment; don't let this process's tracker unlink it on exit
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class StateWriter:
+
+    def __init__(self, name=STATE_NAME):
+        self.shm = _create(name, _LAYOUT.size)
+        self.frame_shm = _create(name + "_frame", _FRAME_SIZE)
+        self.frame_pixels = np.ndarray(MAX_PIXELS, dtype=np.uint32, buffer=self.frame_shm.buf,
+                                       offset=_FRAME.size)
+        self.metrics_shm = _create(name + "_metrics", _METRICS_SIZE)
+        self.metrics_values = np.ndarray(_METRICS_SHAPE, dtype=np.float64, buffer=self.metrics_shm.buf,
+                                         offset=_SEQ.size)
+        self.seq = 0
+        self.frame_seq = 0
+        self.metrics_seq = 0
+        self.pattern = None
+        self.params_version = None
+
+    def publish(self, pattern, params, params_version, brightness, frames, dropped, last_frame_ns, fps,
+                commands):
+        '''commands is a dict of the control queue's received, merged and dropped counts.'''
+        buf = self.shm.buf
+        self.seq += 1
+        _SEQ.pack_into(buf, 0, self.seq)
+        _COUNTERS.pack_into(buf, _COUNTERS_OFFSET, frames, dropped, last_frame_ns, fps, brightness,
+                            commands["received"], commands["merged"], commands["dropped"])
+        if pattern != self.pattern:
+            struct.pack_into("32s", buf, _PATTERN_OFFSET, pattern.encode()[:32])
+            self.pattern = pattern
+        if params_version != self.params_version:
+            encoded = json.dumps(params).encode()[:MAX_PARAMS_BYTES]
+            _PARAMS.pack_into(buf, _PARAMS_OFFSET, len(encoded), encoded)
+            self.params_version = params_version
+        self.seq += 1
+        _SEQ.pack_into(buf, 0, self.seq)
+
+    def publish_frame(self, frames, packed):
+        '''Copy the packed frame that was just sent to the strip.'''
+        buf = self.frame_shm.buf
+        n = min(len(packed), MAX_PIXELS)
+        self.frame_seq += 1
+        _FRAME.pack_into(buf, 0, self.frame_seq, frames, n)
+        self.frame_pixels[:n] = packed[:n]
+        self.frame_seq += 1
+        _SEQ.pack_into(buf, 0, self.frame_seq)
+
+    def publish_metrics(self, metrics):
+        '''Copy the renderer's histograms (a metrics.Metrics).'''
+        buf = self.metrics_shm.buf
+        self.metrics_seq += 1
+        _SEQ.pack_into(buf, 0, self.metrics_seq)
+        self.metrics_values[:] = metrics.values()
+        self.metrics_seq += 1
+        _SEQ.pack_into(buf, 0, self.metrics_seq)
+
+    def close(self):
+        del self.frame_pixels, self.metrics_values  # Release the exported buffers before closing
+        for shm in (self.shm, self.frame_shm, self.metrics_shm):
+            _retire(shm)
+            shm.close()
+            resource_tracker.register(shm._name, "shared_memory")  # unlink() unregisters it, as _create did
+            shm.unlink()
+
+
+class StateReader:
+
+    def __init__(self, name=STATE_NAME):
+        self.name = name
+        self.shm = None
+        self.frame_shm = None
+        self.metrics_shm = None
+
+    def _block(self, attr, suffix=""):
+        '''The mapped block in attr, attaching it, or attaching it again if its daemon retired it.'''
+        shm = getattr(self, attr)
+        if shm is not None and _SEQ.unpack_from(shm.buf, 0)[0] == RETIRED:
+            setattr(self, attr, None)
+            shm.close()
+            shm = None
+        if shm is None:
+            shm = _attach(self.name + suffix)
+            setattr(self, attr, shm)
+        return shm
+
+    def read(self, retries=100):
+        '''
+        Return a consistent snapshot of the renderer state as a dict.
+
+        Raises FileNotFoundError if the daemon has not created the block yet,
+        and TimeoutError if no consistent copy could be taken.
+        '''
+        buf = self._block("shm").buf
+        for _ in range(retries):
+            (before,) = _SEQ.unpack_from(buf, 0)
+            if before % 2:
+                continue
+            data = bytes(buf[:_LAYOUT.size])
+            (after,) = _SEQ.unpack_from(buf, 0)
+            if before == after:
+                break
+        else:
+            raise TimeoutError("Renderer state kept changing while being read")
+
+        (_, frames, dropped, last_frame_ns, fps, brightness, received, merged, dropped_commands,
+         pattern, length, params) = _LAYOUT.unpack(data)
+        return {"current_pattern": pattern.rstrip(b"\0").decode(),
+                "params": json.loads(params[:length]) if length else {},
+                "brightness": brightness,
+                "frames": frames,
+                "dropped": dropped,
+                "fps": fps,
+                "last_frame_ns": last_frame_ns,
+                "commands": {"received": received, "merged": merged, "dropped": dropped_commands},
+                "frame_age_ms": (time.monotonic_ns() - last_frame_ns) / 1e6 if frames else None}
+
+    def read_frame(self, retries=100):
+        '''
+        Return (frame number, packed pixels) for the last frame sent to the
+        strip. The pixels are a copy, as 0x00RRGGBB uint32s.
+
+        Raises FileNotFoundError if the daemon has not created the block yet,
+        and TimeoutError if no consistent copy could be taken.
+        '''
+        buf = self._block("frame_shm", "_frame").buf
+        for _ in range(retries):
+            before, frames, n = _FRAME.unpack_from(buf, 0)
+            if before % 2:
+                continue
+            pixels = np.frombuffer(buf, dtype=np.uint32, count=n, offset=_FRAME.size).copy()
+            (after,) = _SEQ.unpack_from(buf, 0)
+            if before == after:
+                return frames, pixels
+        raise TimeoutError("Frame kept changing while being read")
+
+    def read_metrics(self, retries=100):
+        '''
+        Return a copy of the published histograms, one row per entry of
+        metrics.HISTOGRAMS, as for metrics.prometheus().
+
+        Raises FileNotFoundError if the daemon has not created the block yet,
+        and TimeoutError if no consistent copy could be taken.
+        '''
+        buf = self._block("metrics_shm", "_metrics").buf
+        for _ in range(retries):
+            (before,) = _SEQ.unpack_from(buf, 0)
+            if before % 2:
+                continue
+            values = np.frombuffer(buf, dtype=np.float64, count=_METRICS_SHAPE[0] * _METRICS_SHAPE[1],
+                                   offset=_SEQ.size).reshape(_METRICS_SHAPE).copy()
+            (after,) = _SEQ.unpack_from(buf, 0)
+            if before == after:
+                return values
+        raise TimeoutError("Metrics kept changing while being read")
+
+
+def ui_state(state):
+    '''Flatten a StateReader.read() snapshot into the shape index.html reads.'''
+    params = state["params"]
+    rgb = params.get("rgb", [0, 0, 0])
+    return {"R": rgb[0], "G": rgb[1], "B": rgb[2],
+            "delay_ms": params.get("delay_ms"),
+            "brightness": state["brightness"],
+            "current_pattern": state["current_pattern"],
+            "frames": state["frames"],
+            "dropped": state["dropped"],
+            "fps": state["fps"],
+            "frame_age_ms": state["frame_age_ms"],
+            "commands": state["commands"]}
@@ -1,155 +1,231 @@
+import functools
+import random
 
-from rpi_ws281x import Color
-from random import randint
 import numpy as np
-import time
 
+from compositor import Sprite
 
 
-def light_segment(strip, left_bound, right_bound, rgb, show=True):
+# Animation helpers are generators driven by the render loop. A helper is
+# created with the frame time ``t`` (seconds) at which it starts, acts on that
+# frame as soon as it is advanced, then receives each following frame time
+# through ``send``. When it finishes it returns the time of its last frame so
+# the caller can carry on from there, e.g.:
+#
+#     t = yield from hold(t, delay_ms=500)
+#
+# Sub-animations that can overlap (MovingSegment, Explosion) are Sprites and
+# are run by a compositor.Compositor rather than drawn directly.
+
+
+class Stepper:
+    '''
+    Convert frame times into a count of whole ``delay_ms`` steps.
+
+    Progress is accumulated frame to frame, so a delay that changes mid-pattern
+    changes the speed from then on without making the position jump.
+    '''
+
+    def __init__(self):
+        self.position = 0.0
+        self.last_t = None
+
+    def __call__(self, t, delay_ms):
+        if self.last_t is not None:
+            self.position += (t - self.last_t) * 1000.0 / max(delay_ms, 1)
+        self.last_t = t
+        return int(self.position)
+
+
+def hold(t, delay_ms):
+    '''Keep the current frame for delay_ms.'''
+    end = t + delay_ms / 1000.0
+    while t < end:
+        t = yield
+    return t
+
+
+def light_segment(fb, left_bound, right_bound, rgb):
     '''
     Light a segment of the strip with a single color. 
 
     Parameters:
-    strip: NeoPixel instance
+    fb: FrameBuffer instance
     start: int
         The index of the left most pixel of the segment
     end: int
         The index of the right most pixel of the segment
     
     '''
-    color = Color(*rgb)
-    for i in range(left_bound, right_bound):
-        strip.setPixelColor(i, color)
-    if show:
-        strip.show()
+    fb[max(left_bound, 0):max(right_bound, 0)] = rgb
+
 
-def moving_segment(strip, rgb, lb_start, lb_end, length, step_size, delay_ms):
+class MovingSegment(Sprite):
     '''
-    Light a segment of the strip with a single color and move it along the strip.
+    Segment of a single color moving along the strip.
 
     Parameters:
-    strip: NeoPixel instance
+    rgb: tuple
+        The RGB color of the segment
     lb_start: int
         The starting index of the left most pixel of the segment
     lb_end: int
-        The ending index of the left most pixel of the segment
+        The ending index of the left most pixel of the segment (exclusive)
     length: int
         The length of the segment
-    rgb: tuple
-        The RGB color of the segment
+    step_size: int
+        The number of pixels moved on each step
     delay_ms: int
         The delay in milliseconds between each movement
-    '''
-    rgb = threshold_brightness(strip, rgb)
-
-    if lb_start > lb_end:
-        step = step_size * -1
-    else:
-        step = step_size * 1
-
-    prev_i = lb_start
-    for i in range(lb_start, lb_end - length, step):
-        light_segment(strip, prev_i, prev_i + length, (0, 0, 0), show=False)
-        light_segment(strip, i, i + length, rgb, show=True)
-        prev_i = i
-        time.sleep(delay_ms / 1000.0)
-
 
-def wipe(strip, rgb, start, end, delay_ms):
-    '''Wipe the strip with a single color from start to end.
-
-    Parameters:
-    strip: NeoPixel instance
-    rgb: tuple
-        The RGB color of the wipe
-    start: int
-        The index of the starting pixel
-    end: int
-        The index of the ending pixel
-    delay_ms: int
-        The delay in milliseconds between each iteration
+    Draws nothing once it has reached lb_end.
     '''
-    rgb = threshold_brightness(strip, rgb)
-    for i in range(start, end):
-        strip.setPixelColor(i, Color(*rgb))
-        strip.show()
-        time.sleep(delay_ms / 1000.0)
 
+    def __init__(self, rgb, lb_start, lb_end, length, step_size, delay_ms):
+        step = step_size if lb_end >= lb_start else -step_size
+        self.positions = range(lb_start, lb_end, step)
+        self.rgb = rgb
+        self.length = length
+        self.delay_ms = delay_ms
+        self.stepper = Stepper()
+        self.position = None
+
+    def update(self, t):
+        k = self.stepper(t, self.delay_ms)
+        if k >= len(self.positions):
+            self.position = None
+            return False
+        self.position = self.positions[k]
+        return True
+
+    def draw(self, paint):
+        if self.position is not None:
+            i = self.position
+            paint(slice(max(i, 0), max(i + self.length, 0)), self.rgb)
+
+
+def randomRGB(min_diff=80, rng=random):
+    '''
+    Generate a random RGB color with a minimum difference of min_diff between the channels using rejection sampling.
+    Pass a seeded random.Random as rng for reproducible colors.
+    '''
+    while True:
+        x = [rng.randint(0, 255) for _ in range(3)]
+        if abs(x[0] - x[1]) > min_diff or abs(x[1] - x[2]) > min_diff or abs(x[0] - x[2]) > min_diff:
+            return x
 
 
-def randomRGB(min_diff=80):
-    '''Generate a random RGB color with a minimum difference of min_diff between the channels using rejection sampling.'''
-    x = [randint(0, 255) for _ in range(3)]
-    if np.abs(x[0] -  x[1]) > min_diff or np.abs(x[1] - x[2]) > min_diff or np.abs(x[0] - x[2]) > min_diff:
-        return x
-    else:
-        return randomRGB()
+@functools.lru_cache(maxsize=None)
+def explosion_profile(size, fade):
+    '''
+    Brightness of each pixel of a fully spread explosion, left to right: the
+    centre at 1.0 falling linearly to fade over size // 2 rings on each side.
+    Computed once per (size, fade) and shared, so it is read-only.
+    '''
+    falloff = np.linspace(1.0, fade, size // 2)
+    profile = np.concatenate([falloff[:0:-1], falloff])
+    profile.flags.writeable = False
+    return profile
 
 
-def explosion(strip, rgb: tuple, center, size=80, fade=0, delay_ms=20):
+class Explosion(Sprite):
     '''Create an explosion effect
-    
+
     Parameters:
-    strip: NeoPixel instance
     rgb: tuple
         The RGB color of the explosion
     center: int
         The index of the center of the explosion
+    num_pixels: int
+        Length of the strip, to keep the explosion on it
     size: int
         The size of the explosion
-    fade: int
-        The amount of fading of the explosion. Int between 0 and 1.
-        The lower the value, the less bright, the explosion will be as it moves away from the center.
+    fade: float
+        Brightness of the outermost ring relative to the center, between 0 and 1.
+        The lower the value, the dimmer the explosion gets away from the center.
     delay_ms: int
         The delay in milliseconds between each iteration
+
+    One ring spreads out on each step. Rings too dim to see (mean level
+    below 10) are left out. The explosion stays lit once it has finished
+    spreading. Its colors are the shared radial profile scaled by rgb, so
+    there is nothing to compute per frame beyond which span is lit.
     '''
-    assert fade >= 0 and fade <= 1, "Fade must be between 0 and 1"
-    fade = np.linspace(1.0, fade, size//2)
-    for i in range(size//2):
-        rgb = [int(c * (fade[i])) for c in rgb]
-        if np.mean(rgb) < 10:
-            break
-        color = Color(*rgb)
-        strip.setPixelColor(center + i, color)
-        strip.setPixelColor(center - i, color)
-        strip.show()
-        if i < size//2 - 1:
-            time.sleep(delay_ms / 1000.0)
-        
+
+    def __init__(self, rgb, center, num_pixels, size=80, fade=0, delay_ms=20):
+        assert fade >= 0 and fade <= 1, "Fade must be between 0 and 1"
+        half = size // 2
+        colors = np.rint(explosion_profile(size, fade)[:, None] * np.asarray(rgb, dtype=np.float64)).astype(np.uint8)
+        visible = colors[max(half - 1, 0):].mean(axis=1) >= 10  # Center outwards
+        self.rings = int(visible.argmin()) if not visible.all() else half
+        self.colors = colors[half - self.rings:half + self.rings - 1] if self.rings else colors[:0]
+        self.center = center
+        self.num_pixels = num_pixels
+        self.delay_ms = delay_ms
+        self.stepper = Stepper()
+        self.lit = 0
+
+    def update(self, t):
+        k = self.stepper(t, self.delay_ms)
+        self.lit = min(k + 1, self.rings)
+        return k + 1 < self.rings
+
+    def draw(self, paint):
+        if not self.lit:
+            return
+        # The lit rings are one contiguous span, so paint a slice of the precomputed colors
+        first = self.center - self.rings + 1  # Pixel under self.colors[0]
+        lo = max(self.center - self.lit + 1, 0)
+        hi = min(self.center + self.lit, self.num_pixels)
+        if lo < hi:
+            paint(slice(lo, hi), self.colors[lo - first:hi - first])
+
+
+def _wheel_table():
+    '''Rainbow colors for positions 0-255 as a (256, 3) uint8 table.'''
+    pos = np.arange(256)
+    segment = (pos >= 85).astype(np.int32) + (pos >= 170)
+    up = (pos - segment * 85) * 3
+    down = 255 - up
+    zero = np.zeros_like(pos)
+    r = np.choose(segment, [up, down, zero])
+    g = np.choose(segment, [down, zero, up])
+    b = np.choose(segment, [zero, up, down])
+    return np.stack([r, g, b], axis=-1).astype(np.uint8)
+
+
+WHEEL_RGB = _wheel_table()
+WHEEL_PACKED = ((WHEEL_RGB[:, 0].astype(np.uint32) << 16)
+                | (WHEEL_RGB[:, 1].astype(np.uint32) << 8)
+                | WHEEL_RGB[:, 2])
+
 
 def wheel(pos):
     """Generate rainbow colors across 0-255 positions."""
-    if pos < 85:
-        R, G, B = pos * 3, 255 - pos * 3, 0
-        return Color(R, G, B)
-    elif pos < 170:
-        pos -= 85
-        R, G, B= 255 - pos * 3, 0, pos * 3
-        return Color(R, G, B)
-    else:
-        pos -= 170
-        R, G, B = 0, pos * 3, 255 - pos * 3
-        return Color(R, G, B)
-    
+    return int(WHEEL_PACKED[pos & 255])
 
-def getMeanBrightness(strip):
-    '''Get the mean brightness of the strip'''
-    return np.mean([strip.getPixelColor(i) for i in range(strip.numPixels())])
 
+def wheel_rgb(pos):
+    '''Vectorized wheel: map an array of 0-255 positions to an (N, 3) uint8 array of colors.'''
+    return WHEEL_RGB[np.asarray(pos) & 255]
 
-def threshold_brightness(strip, rgb, threshold=127):
-    '''TODO: NOT WORKING BECAUSE IT'S NOT TAKING INTO ACCOUNT THE BRIGHTNESS AFTER THE FUNCTION RUNS.'''
-    # Calculate the total brightness of the RGB tuple
-    mean_brightness = getMeanBrightness(strip)
 
-    # Check if total brightness exceeds the threshold
-    if mean_brightness > threshold:
-        # Calculate the scaling factor to dampen brightness
-        scale_factor = threshold / mean_brightness
+def channel_table(gamma=1.0, brightness=1.0, balance=(1.0, 1.0, 1.0)):
+    '''
+    Per-channel output lookup table applied when a frame is committed.
 
-        # Dampen the brightness of each component proportionally
-        dampened_rgb = tuple(int(value * scale_factor) for value in rgb)
-        return dampened_rgb
-    else:
-        return rgb    
+    Parameters:
+    gamma: float
+        Gamma exponent. 1.0 is linear; 2.2-2.8 gives perceptually even fades.
+    brightness: float
+        Global brightness scale between 0 and 1
+    balance: tuple
+        Per-channel (R, G, B) scale, e.g. to white-balance a strip
+
+    Returns a (3, 256) float array of output levels between 0 and 255,
+    indexed by [channel, value]. It is left unrounded, so a dithering
+    framebuffer can show the fractions.
+    '''
+    levels = (np.arange(256) / 255.0) ** gamma
+    scale = np.asarray(balance, dtype=np.float64)[:, None] * brightness
+    return np.clip(levels[None, :] * scale * 255, 0, 255)
@@ -0,0 +1,149 @@
+'''
+Transitions between patterns.
+
+Without a transition a pattern switch is a hard cut: the outgoing pattern
+is closed at the frame boundary and the incoming one draws its first frame
+straight over whatever was on the strip. With one, the renderer hands the
+outgoing pattern to a Transition instead of closing it. For the length of
+the transition both patterns keep running, the incoming one into a
+framebuffer of its own, and every frame the two are blended into the
+strip's framebuffer:
+
+- "fade": a crossfade, in integer 1/256 steps;
+- "wipe": the incoming pattern sweeps in from the start of the strip;
+- "dissolve": pixels switch over one at a time, in a fixed random order.
+
+A transition is just another pattern generator as far as the render loop
+is concerned, so it still commits and shows once per tick. When it ends,
+the outgoing pattern is closed and the incoming one carries on, copied into
+the strip's framebuffer each frame.
+'''
+import numpy as np
+
+from registry import Param
+
+KINDS = ("fade", "wipe", "dissolve")
+SECONDS = Param("transition_s", "float", 0.5, 0, 10)
+
+
+class Blend:
+    '''
+    Mixes two frames of num_pixels pixels in preallocated buffers.
+
+    Calling it with a kind from KINDS, the frames under (outgoing) and over
+    (incoming) and the progress between 0 and 1 returns the blended frame.
+    The result is one of the blend's own buffers, valid until the next call.
+    '''
+
+    def __init__(self, num_pixels, seed=0):
+        self._mix = np.zeros((num_pixels, 3), dtype=np.uint16)
+        self._under = np.zeros((num_pixels, 3), dtype=np.uint16)
+        self._out = np.zeros((num_pixels, 3), dtype=np.uint8)
+        self._mask = np.zeros(num_pixels, dtype=bool)
+        self._order = np.random.default_rng(seed).permutation(num_pixels)  # When each pixel dissolves
+
+    def __call__(self, kind, under, over, progress):
+        if kind == "fade":
+            weight = min(max(int(256 * progress), 0), 256)
+            mix = self._mix
+            mix[:] = over
+            mix *= weight
+            self._under[:] = under
+            self._under *= 256 - weight
+            mix += self._under
+            mix >>= 8
+            return mix
+        out = self._out
+        k = int(len(out) * progress)
+        if kind == "wipe":
+            out[:k] = over[:k]
+            out[k:] = under[k:]
+        elif kind == "dissolve":
+            np.less(self._order, k, out=self._mask)
+            out[:] = under
+            np.copyto(out, over, where=self._mask[:, None])
+        else:
+            raise ValueError(f"Unknown transition {kind!r}")
+        return out
+
+
+class Transition:
+    '''
+    Parameters:
+    kind: str
+        One of KINDS
+    seconds: float
+        Length of the transition. 0 is a hard cut
+    '''
+
+    def __init__(self, kind="fade", seconds=SECONDS.default):
+        if kind not in KINDS:
+            raise ValueError(f"transition must be one of {', '.join(KINDS)}")
+        self.kind = kind
+        self.seconds = SECONDS.parse(seconds)
+
+    @classmethod
+    def parse(cls, spec):
+        '''Build a transition from a {"kind", "seconds"} dict, as sent to the daemon. Raises ValueError if invalid.'''
+        if not isinstance(spec, dict):
+            raise ValueError("transition must be an object with a kind and seconds")
+        return cls(spec.get("kind", "fade"), spec.get("seconds", SECONDS.default))
+
+    def describe(self):
+        return {"kind": self.kind, "seconds": self.seconds}
+
+    def play(self, fb, incoming_fb, incoming, outgoing=None, release=None, elapsed=0.0):
+        '''
+        Pattern generator that blends from outgoing into incoming, then
+        keeps incoming running.
+
+        Parameters:
+        fb: FrameBuffer instance
+            The strip's framebuffer, which outgoing draws into
+        incoming_fb: FrameBuffer instance
+            The framebuffer incoming draws into
+        incoming: generator
+            The new pattern, not started yet
+        outgoing: generator
+            The running pattern being replaced, or None to blend from the frame on the strip
+        release: callable
+            Closes outgoing, in place of outgoing.close()
+        elapsed: float
+            Seconds outgoing had been running for, so its clock carries on
+        '''
+        blend = Blend(len(fb))
+        held = fb.pixels.copy()  # Outgoing's own frame, which the blends overwrite in fb
+        try:
+            next(incoming)
+            t = yield
+            while t < self.seconds:
+                if outgoing is not None:
+                    fb[:] = held  # Give outgoing back its frame, in case it draws on top of it
+                    try:
+                        outgoing.send(elapsed + t)
+                    except StopIteration:
+                        outgoing = self._release(outgoing, release)
+                    held[:] = fb.pixels
+                try:
+                    incoming.send(t)
+                except StopIteration:
+                    pass  # Finished early; hold its last frame
+                fb[:] = blend(self.kind, held, incoming_fb.pixels, t / self.seconds)
+                t = yield
+            outgoing = self._release(outgoing, release)
+            while True:
+                try:
+                    incoming.send(t)
+                except StopIteration:
+                    return
+                fb[:] = incoming_fb.pixels
+                t = yield
+        finally:
+            incoming.close()
+            self._release(outgoing, release)
+
+    @staticmethod
+    def _release(outgoing, release):
+        if outgoing is not None:
+            (release or outgoing.close)()
+        return None